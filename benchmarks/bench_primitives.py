@@ -0,0 +1,119 @@
+'''
+Micro-benchmarks of the scene hashing & set matching primitives over synthetic
+product lists, run with pytest-benchmark:
+
+    pip install -r benchmarks/requirements.txt
+    pytest benchmarks/bench_primitives.py [--benchmark-json out.json]
+
+SPV_BENCH_SIZES sets the list sizes, 1000 to 1000000 by default. The memoized
+hashes are cleared before every round so each round hashes from scratch.
+'''
+
+import os
+import sys
+import pytest
+pytest.importorskip('pytest_benchmark')
+import scene_key
+import tagger
+import synthetic
+from conftest import ALLOCATIONS
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = [int(x) for x in os.environ.get('SPV_BENCH_SIZES', '1000,10000,100000,1000000').split(',')]
+ROUND_ITEMS = 10 ** 5 # items processed across the rounds of a benchmark, within MIN_ROUNDS & MAX_ROUNDS
+MIN_ROUNDS = 3
+MAX_ROUNDS = 100
+
+_PRODUCTS = {}
+
+@pytest.fixture(scope='module', params=SIZES)
+def size(request):
+    '''the list size, as a module scoped fixture so pytest runs every benchmark of a size together'''
+    return request.param
+
+def products(size):
+    '''returns the (acq-list, ifg, blacklist) product lists of the size, sharing scene ids'''
+    if size not in _PRODUCTS:
+        _PRODUCTS.clear()
+        acq_lists, ifgs, blacklist = [], [], []
+        for i in range(size):
+            master, slave = synthetic.scenes(i)
+            met = {'master_scenes': master, 'slave_scenes': slave}
+            if synthetic.stores_hash(i):
+                met['full_id_hash'] = synthetic.full_id_hash(master, slave)
+            acq_lists.append({'_id': 'acquisition-list-{0}'.format(i), '_source': {'metadata': met}})
+            if synthetic.has_ifg(i):
+                ifgs.append({'_id': 'S1-GUNW-{0}'.format(i), '_source': {'metadata': met}})
+            elif synthetic.is_blacklisted(i):
+                blacklist.append({'_id': 'S1-GUNW-BLACKLIST-{0}'.format(i), '_source': {'metadata': met}})
+        _PRODUCTS[size] = acq_lists, ifgs, blacklist
+    return _PRODUCTS[size]
+
+def clear_caches():
+    scene_key.direct_hash.cache.clear()
+    scene_key.pair_hash.cache.clear()
+
+def run(benchmark, func, size):
+    '''times func over cleared caches, recording items/sec & the allocations of one more run'''
+    rounds = max(MIN_ROUNDS, min(MAX_ROUNDS, ROUND_ITEMS // size))
+    result = benchmark.pedantic(func, setup=clear_caches, rounds=rounds, iterations=1)
+    benchmark.extra_info['items'] = size
+    benchmark.extra_info['items_per_sec'] = size / benchmark.stats.stats.mean
+    if tracemalloc is not None:
+        clear_caches()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        try:
+            retained = func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info['alloc_peak_bytes'] = peak
+        benchmark.extra_info['alloc_retained_blocks'] = sys.getallocatedblocks() - blocks
+        ALLOCATIONS.append((benchmark.name, peak, benchmark.extra_info['alloc_retained_blocks']))
+        del retained
+    return result
+
+def test_get_starttime(benchmark, size):
+    scene_ids = [obj['_source']['metadata']['master_scenes'][0] for obj in products(size)[0]]
+    run(benchmark, lambda: [scene_key.get_starttime(x) for x in scene_ids], size)
+
+def test_gen_direct_hash(benchmark, size):
+    '''the hash of a failed job's master/slave slcs, once generate_*_from_job's gen_direct_hash'''
+    scenes = [(obj['_source']['metadata']['master_scenes'], obj['_source']['metadata']['slave_scenes']) for obj in products(size)[0]]
+    run(benchmark, lambda: [scene_key.from_scenes(master, slave).direct_hash for master, slave in scenes], size)
+
+def test_gen_hash(benchmark, size):
+    '''the starttime hash of an acq-list, once tagger & generate_blacklist's gen_hash'''
+    objects = products(size)[0]
+    run(benchmark, lambda: [scene_key.from_es_object(obj).pair_hash for obj in objects], size)
+
+def test_build_hashed_dict(benchmark, size):
+    acq_lists = products(size)[0]
+    run(benchmark, lambda: tagger.build_hashed_dict(acq_lists), size)
+
+def test_contains(benchmark, size):
+    '''every acq-list is contained, so contains checks them all rather than stopping at a miss'''
+    _, ifgs, _ = products(size)
+    contained = [obj for i, obj in enumerate(products(size)[0]) if synthetic.has_ifg(i)]
+    assert run(benchmark, lambda: tagger.contains(ifgs, contained), size)
+
+def test_return_missing(benchmark, size):
+    acq_lists, ifgs, _ = products(size)
+    run(benchmark, lambda: tagger.return_missing(ifgs, acq_lists), size)
+
+def test_return_matching(benchmark, size):
+    acq_lists, _, blacklist = products(size)
+    run(benchmark, lambda: tagger.return_matching(blacklist, acq_lists), size)
+
+def test_evaluate_aoi_matching(benchmark, size):
+    '''the matching done per AOI by tagger.evaluate_aoi when no blacklist matches'''
+    acq_lists, ifgs, _ = products(size)
+    def evaluate():
+        if tagger.return_matching([], acq_lists) or tagger.contains(ifgs, acq_lists):
+            return []
+        return tagger.return_missing(ifgs, acq_lists)
+    run(benchmark, evaluate, size)
@@ -0,0 +1,33 @@
+'''
+pytest setup for the micro-benchmarks: puts the repo modules on the path & prints
+the allocations recorded by bench_primitives.py after the timings. Without hysds,
+which is only installed on the workers, a stand-in hysds.celery is registered so the
+scripts import. The primitives benchmarked never read its config.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+try:
+    import hysds.celery
+except ImportError:
+    hysds = types.ModuleType('hysds')
+    hysds.celery = types.ModuleType('hysds.celery')
+    hysds.celery.app = type('App', (object,), {'conf': {}})()
+    sys.modules.update({'hysds': hysds, 'hysds.celery': hysds.celery})
+
+ALLOCATIONS = [] # (benchmark name, peak bytes, retained blocks)
+
+def pytest_terminal_summary(terminalreporter):
+    if not ALLOCATIONS:
+        return
+    terminalreporter.write_sep('-', 'allocations (one untimed run under tracemalloc)')
+    terminalreporter.write_line('{0:<50} {1:>14} {2:>16}'.format('name', 'peak KiB', 'retained blocks'))
+    for name, peak, blocks in ALLOCATIONS:
+        terminalreporter.write_line('{0:<50} {1:>14.1f} {2:>16}'.format(name, peak / 1024.0, blocks))
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+
+'''
+Local stand-in for GRQ, the Mozart jobs ES & the Mozart job submit api, for the
+benchmarks. Holds synthetic documents in memory & implements the subset of
+_search, scroll, _msearch, _bulk & _update that the scripts of this repo use.
+
+usage: fake_es.py --scale 10000 [--port 0]
+'''
+
+from __future__ import print_function
+import re
+import sys
+import json
+import gzip
+import time
+import fnmatch
+import argparse
+import datetime
+import threading
+from io import BytesIO
+from collections import OrderedDict
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+import synthetic
+
+try:
+    STRING_TYPES = (basestring,)
+except NameError:
+    STRING_TYPES = (str,)
+
+GRQ_PREFIX = '/es'
+JOBS_PREFIX = '/mozart_es'
+MOZART_PREFIX = '/mozart'
+INGEST_PATH = '/_bench/ingest' # GRQ_UPDATE_URL of the benchmarked jobs
+DATE_MATH = re.compile(r'([+-])(\d+)([smhd])')
+DATE_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+class Store(object):
+    '''in-memory indices of documents, with lazily built per field value lookups'''
+
+    def __init__(self):
+        self.indices = OrderedDict()
+        self.scrolls = {}
+        self.lock = threading.RLock()
+        self._lookups = {}
+        self._scroll_ids = 0
+
+    def load(self, documents):
+        for index, doc_type, doc_id, source in documents:
+            self.put(index, doc_type, doc_id, source)
+
+    def put(self, index, doc_type, doc_id, source):
+        with self.lock:
+            self.indices.setdefault(index, OrderedDict())[doc_id] = {'_index': index, '_type': doc_type, '_id': doc_id, '_source': source}
+            self._drop_lookups(index)
+
+    def _drop_lookups(self, index):
+        for key in [key for key in self._lookups if key[0] == index]:
+            del self._lookups[key]
+
+    def resolve(self, pattern):
+        '''returns the index names matching the comma separated index patterns'''
+        names = []
+        for part in pattern.split(','):
+            names.extend(name for name in self.indices if fnmatch.fnmatch(name, part) and name not in names)
+        return names
+
+    def lookup(self, index, field):
+        '''returns a dict of the values of the field on the index to the ids holding them'''
+        key = (index, field)
+        if key not in self._lookups:
+            values = {}
+            for doc_id, doc in self.indices[index].items():
+                for value in field_values(doc, field):
+                    values.setdefault(_hashable(value), []).append(doc_id)
+            self._lookups[key] = values
+        return self._lookups[key]
+
+    def candidates(self, index, query):
+        '''returns the docs of the index that can match the query, using a field lookup if it has a required term'''
+        clause = required_terms(query)
+        if clause is None:
+            return list(self.indices[index].values())
+        field, values = clause
+        docs = self.indices[index]
+        if field == '_id':
+            ids = values
+        else:
+            lookup = self.lookup(index, field)
+            ids = []
+            for value in values:
+                ids.extend(lookup.get(_hashable(value), []))
+        seen = set()
+        return [docs[x] for x in ids if x in docs and not (x in seen or seen.add(x))]
+
+    def search(self, pattern, body, scroll=None):
+        '''runs the search body over the index pattern, opening a scroll if asked'''
+        query = body.get('query', {'match_all': {}})
+        with self.lock:
+            hits = []
+            for index in self.resolve(pattern):
+                hits.extend(doc for doc in self.candidates(index, query) if matches(doc, query))
+        hits = sort_hits(hits, body.get('sort'))
+        response = {'took': 1, 'timed_out': False, 'hits': {'total': len(hits), 'max_score': None, 'hits': []}}
+        if body.get('aggs') or body.get('aggregations'):
+            response['aggregations'] = aggregate(body.get('aggs') or body.get('aggregations'), hits)
+        size = body.get('size', 10)
+        if scroll:
+            with self.lock:
+                self._scroll_ids += 1
+                scroll_id = 'scroll-{0}'.format(self._scroll_ids)
+                self.scrolls[scroll_id] = {'hits': hits, 'position': size, 'size': size, 'source': body.get('_source')}
+            response['_scroll_id'] = scroll_id
+            page = hits[:size]
+        else:
+            start = body.get('from', 0)
+            page = hits[start:start + size]
+        response['hits']['hits'] = [project(doc, body.get('_source')) for doc in page]
+        return response
+
+    def scroll(self, scroll_id):
+        with self.lock:
+            state = self.scrolls.get(scroll_id)
+            if state is None:
+                return None
+            page = state['hits'][state['position']:state['position'] + state['size']]
+            state['position'] += state['size']
+        return {'_scroll_id': scroll_id, 'took': 1, 'timed_out': False,
+                'hits': {'total': len(state['hits']), 'hits': [project(doc, state['source']) for doc in page]}}
+
+    def clear_scroll(self, scroll_ids):
+        with self.lock:
+            for scroll_id in scroll_ids:
+                self.scrolls.pop(scroll_id, None)
+
+    def update(self, index, doc_id, body):
+        '''applies an update body, a partial doc or the tag swap script. Returns the result or raises KeyError'''
+        with self.lock:
+            doc = self.indices.get(index, {}).get(doc_id)
+            if doc is None:
+                raise KeyError(doc_id)
+            if 'doc' in body:
+                merge(doc['_source'], body['doc'])
+                result = 'updated'
+            else:
+                result = run_script(doc['_source'], body.get('script'), body.get('params') or {})
+            if result == 'updated':
+                self._drop_lookups(index)
+            return result
+
+def field_values(doc, field):
+    '''returns the leaf values of the dotted field of the doc, a .raw suffix is the field itself'''
+    if field in ('_id', '_index', '_type'):
+        return [doc[field]]
+    if field.endswith('.raw'):
+        field = field[:-4]
+    values = [doc['_source']]
+    for part in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                item = value[part]
+                found.extend(item if isinstance(item, list) else [item])
+        values = found
+    return values
+
+def _hashable(value):
+    return json.dumps(value, sort_keys=True) if isinstance(value, (dict, list)) else value
+
+def required_terms(query):
+    '''returns the (field, values) of a term, terms or ids clause every match must meet, or None'''
+    if 'filtered' in query:
+        return required_terms(query['filtered'].get('filter', {})) or required_terms(query['filtered'].get('query', {}))
+    if 'bool' in query:
+        must = query['bool'].get('must', [])
+        for clause in must if isinstance(must, list) else [must]:
+            terms = required_terms(clause)
+            if terms is not None:
+                return terms
+        return None
+    if 'term' in query:
+        field, value = list(query['term'].items())[0]
+        return field, [value.get('value') if isinstance(value, dict) else value]
+    if 'terms' in query:
+        field, values = list(query['terms'].items())[0]
+        return field, values
+    if 'ids' in query:
+        return '_id', query['ids'].get('values', [])
+    return None
+
+def matches(doc, query):
+    '''returns True if the doc matches the query clause'''
+    if not query or 'match_all' in query:
+        return True
+    if 'filtered' in query:
+        return matches(doc, query['filtered'].get('query', {})) and matches(doc, query['filtered'].get('filter', {}))
+    if 'bool' in query:
+        clauses = query['bool']
+        listed = lambda name: clauses.get(name, []) if isinstance(clauses.get(name, []), list) else [clauses[name]]
+        if not all(matches(doc, clause) for clause in listed('must') + listed('filter')):
+            return False
+        if any(matches(doc, clause) for clause in listed('must_not')):
+            return False
+        should = listed('should')
+        return not should or any(matches(doc, clause) for clause in should)
+    if 'term' in query:
+        field, value = list(query['term'].items())[0]
+        value = value.get('value') if isinstance(value, dict) else value
+        return value in field_values(doc, field)
+    if 'terms' in query:
+        field, values = list(query['terms'].items())[0]
+        return bool(set(_hashable(x) for x in field_values(doc, field)) & set(_hashable(x) for x in values))
+    if 'ids' in query:
+        return doc['_id'] in query['ids'].get('values', [])
+    if 'exists' in query:
+        return bool(field_values(doc, query['exists']['field']))
+    if 'missing' in query:
+        return not field_values(doc, query['missing']['field'])
+    if 'range' in query:
+        field, bounds = list(query['range'].items())[0]
+        return any(in_range(value, bounds) for value in field_values(doc, field))
+    if 'geo_shape' in query:
+        field, spec = list(query['geo_shape'].items())[0]
+        shape = bbox(spec.get('shape', {}).get('coordinates', []))
+        return any(intersects(bbox(value.get('coordinates', [])), shape) for value in field_values(doc, field) if isinstance(value, dict))
+    raise ValueError('unsupported query clause: {0}'.format(list(query.keys())))
+
+def in_range(value, bounds):
+    for name, compare in (('gte', lambda x, y: x >= y), ('from', lambda x, y: x >= y), ('gt', lambda x, y: x > y),
+                          ('lte', lambda x, y: x <= y), ('to', lambda x, y: x <= y), ('lt', lambda x, y: x < y)):
+        bound = bounds.get(name)
+        if bound is not None and not compare(value, date_math(bound)):
+            return False
+    return True
+
+def date_math(value):
+    '''resolves an ES date math expression such as 2019-01-01T00:00:00||-1h'''
+    if not isinstance(value, STRING_TYPES) or '||' not in value:
+        return value
+    anchor, expression = value.split('||', 1)
+    when = datetime.datetime.strptime(anchor[:19], synthetic.TIME_FORMAT)
+    for sign, amount, unit in DATE_MATH.findall(expression):
+        delta = datetime.timedelta(**{DATE_UNITS[unit]: int(amount)})
+        when = when + delta if sign == '+' else when - delta
+    return when.strftime(synthetic.TIME_FORMAT)
+
+def bbox(coordinates):
+    '''returns the (min x, min y, max x, max y) of nested geojson coordinates'''
+    points = []
+    stack = [coordinates]
+    while stack:
+        item = stack.pop()
+        if item and isinstance(item[0], (int, float)):
+            points.append(item)
+        else:
+            stack.extend(item)
+    if not points:
+        return None
+    return (min(x[0] for x in points), min(x[1] for x in points), max(x[0] for x in points), max(x[1] for x in points))
+
+def intersects(box1, box2):
+    if box1 is None or box2 is None:
+        return False
+    return box1[0] <= box2[2] and box2[0] <= box1[2] and box1[1] <= box2[3] and box2[1] <= box1[3]
+
+def sort_hits(hits, sort):
+    '''sorts the hits on the given sort fields, _doc keeps index order'''
+    for spec in reversed(sort or []):
+        if spec == '_doc' or spec == {'_doc': 'asc'}:
+            continue
+        field, order = list(spec.items())[0] if isinstance(spec, dict) else (spec, 'asc')
+        order = order.get('order', 'asc') if isinstance(order, dict) else order
+        hits = sorted(hits, key=lambda doc: (field_values(doc, field) or [''])[0], reverse=order == 'desc')
+    return hits
+
+def project(doc, fields):
+    '''returns the hit with its _source filtered to the given dotted fields'''
+    hit = {'_index': doc['_index'], '_type': doc['_type'], '_id': doc['_id'], '_score': 1.0}
+    if fields is None or fields is True:
+        hit['_source'] = doc['_source']
+        return hit
+    source = {}
+    for field in [fields] if isinstance(fields, STRING_TYPES) else fields:
+        value = doc['_source']
+        parts = field.split('.')
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = source
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    hit['_source'] = source
+    return hit
+
+def aggregate(aggs, hits):
+    '''computes the terms & max aggregations over the hits'''
+    results = {}
+    for name, spec in aggs.items():
+        sub_aggs = spec.get('aggs') or spec.get('aggregations')
+        if 'terms' in spec:
+            field = spec['terms']['field']
+            size = spec['terms'].get('size', 10)
+            groups = OrderedDict()
+            for doc in hits:
+                for value in set(_hashable(x) for x in field_values(doc, field)):
+                    groups.setdefault(value, []).append(doc)
+            ordered = sorted(groups.items(), key=lambda item: -len(item[1]))
+            buckets = []
+            for key, docs in ordered[:size or None]:
+                bucket = {'key': key, 'doc_count': len(docs)}
+                if sub_aggs:
+                    bucket.update(aggregate(sub_aggs, docs))
+                buckets.append(bucket)
+            results[name] = {'buckets': buckets}
+        elif 'max' in spec:
+            values = [value for doc in hits for value in field_values(doc, spec['max']['field'])]
+            latest = max(values) if values else None
+            if isinstance(latest, STRING_TYPES):
+                results[name] = {'value': None, 'value_as_string': latest}
+            else:
+                results[name] = {'value': latest}
+        else:
+            raise ValueError('unsupported aggregation: {0}'.format(list(spec.keys())))
+    return results
+
+def merge(target, doc):
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+def run_script(source, script, params):
+    '''emulates the scripted updates sent by this repo, currently the tagger's tag swap'''
+    if 'new_tag' not in params or 'remove_tags' not in params:
+        raise ValueError('unsupported script: {0}'.format(script))
+    met = source.setdefault('metadata', {})
+    current = met.get('tags') or []
+    updated = [tag for tag in current if tag not in params['remove_tags']]
+    if params['new_tag'] not in updated:
+        updated.append(params['new_tag'])
+    if set(updated) == set(current):
+        return 'noop'
+    met['tags'] = updated
+    return 'updated'
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def read_body(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=BytesIO(data)).read()
+        return data.decode('utf-8')
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        body = self.read_body()
+        try:
+            status, response = self.server.app.route(method, url.path, parse_qs(url.query), body)
+        except Exception as err:
+            status, response = 500, {'error': '{0}: {1}'.format(type(err).__name__, err)}
+        self.respond(status, response)
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeES(object):
+    '''routes requests to the store & counts them per endpoint'''
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.store = None
+        self.dirty = True
+        self.stats = {}
+        self.jobs = 0
+        self.reset()
+
+    def reset(self):
+        '''reloads the synthetic documents if a flow changed them, & zeroes the request counts'''
+        if self.dirty:
+            start = time.time()
+            self.store = Store()
+            self.store.load(synthetic.documents(self.scale))
+            self.dirty = False
+            print('loaded {0} documents in {1:.1f}s'.format(sum(len(x) for x in self.store.indices.values()), time.time() - start))
+            sys.stdout.flush()
+        self.stats = {}
+
+    def count(self, endpoint):
+        self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+    def route(self, method, path, params, body):
+        if path == '/_bench/stats':
+            return 200, {'requests': sum(self.stats.values()), 'endpoints': self.stats,
+                         'documents': dict((name, len(docs)) for name, docs in self.store.indices.items())}
+        if path == '/_bench/reset':
+            self.reset()
+            return 200, {'acknowledged': True}
+        if path == INGEST_PATH:
+            self.count('ingest')
+            request = json.loads(body)
+            self.store.put(request['index'], request['type'], request['id'], request['source'])
+            self.dirty = True
+            return 200, {'acknowledged': True}
+        if path.startswith(MOZART_PREFIX + '/api/'):
+            self.count('job_submit')
+            self.jobs += 1
+            return 200, {'success': True, 'result': 'bench-job-{0}'.format(self.jobs)}
+        for prefix in (GRQ_PREFIX, JOBS_PREFIX):
+            if path.startswith(prefix + '/'):
+                return self.route_es(method, path[len(prefix) + 1:].strip('/').split('/'), params, body)
+        return 404, {'error': 'unknown path {0}'.format(path)}
+
+    def route_es(self, method, parts, params, body):
+        if parts == ['_search', 'scroll']:
+            request = json.loads(body) if body else {}
+            if method == 'DELETE':
+                self.count('clear_scroll')
+                scroll_ids = request.get('scroll_id', [])
+                self.store.clear_scroll(scroll_ids if isinstance(scroll_ids, list) else [scroll_ids])
+                return 200, {'succeeded': True}
+            self.count('scroll')
+            response = self.store.scroll(request.get('scroll_id'))
+            return (200, response) if response is not None else (404, {'error': 'no such scroll'})
+        if parts == ['_msearch']:
+            self.count('msearch')
+            lines = [json.loads(line) for line in body.split('\n') if line.strip()]
+            responses = []
+            for header, request in zip(lines[0::2], lines[1::2]):
+                try:
+                    responses.append(self.store.search(header.get('index', '*'), request))
+                except ValueError as err:
+                    responses.append({'error': str(err)})
+            return 200, {'responses': responses}
+        if parts == ['_bulk']:
+            self.count('bulk')
+            return 200, self.bulk(body)
+        if len(parts) == 2 and parts[1] == '_search':
+            self.count('search')
+            request = json.loads(body) if body else {}
+            return 200, self.store.search(parts[0], request, scroll=params.get('scroll', [None])[0])
+        if len(parts) == 4 and parts[3] == '_update':
+            self.count('update')
+            try:
+                result = self.store.update(parts[0], parts[2], json.loads(body))
+            except KeyError:
+                return 404, {'error': 'document_missing_exception', '_id': parts[2]}
+            self.dirty = True
+            return 200, {'_index': parts[0], '_type': parts[1], '_id': parts[2], 'result': result}
+        return 404, {'error': 'unsupported endpoint {0}'.format('/'.join(parts))}
+
+    def bulk(self, body):
+        '''applies index & update actions, returning the bulk response'''
+        lines = [json.loads(line) for line in body.split('\n') if line.strip()]
+        items = []
+        errors = False
+        position = 0
+        while position < len(lines):
+            action, meta = list(lines[position].items())[0]
+            source = lines[position + 1] if action != 'delete' else None
+            position += 1 if action == 'delete' else 2
+            item = {'_index': meta.get('_index'), '_type': meta.get('_type'), '_id': meta.get('_id')}
+            if action in ('index', 'create'):
+                self.store.put(meta['_index'], meta.get('_type'), meta['_id'], source)
+                item['status'] = 201
+            elif action == 'update':
+                try:
+                    item['result'] = self.store.update(meta['_index'], meta['_id'], source)
+                    item['status'] = 200
+                except KeyError:
+                    item['status'] = 404
+                    item['error'] = {'type': 'document_missing_exception'}
+            else:
+                item['status'] = 400
+                item['error'] = {'type': 'unsupported action {0}'.format(action)}
+            errors = errors or 'error' in item
+            self.dirty = True
+            items.append({action: item})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+def serve(scale, port=0):
+    '''loads the scale & serves until interrupted, printing the port once listening'''
+    server = ThreadingServer(('127.0.0.1', port), Handler)
+    server.app = FakeES(scale)
+    print('listening on {0}'.format(server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', type=int, default=1000, help='number of synthetic scene pairs')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+    serve(args.scale, args.port)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+'''
+End-to-end benchmarks of the job scripts against a local fake GRQ/Mozart server
+(fake_es.py) loaded with synthetic documents. Each flow runs in its own process
+& work directory, recording wall time, requests served & peak RSS per scale.
+
+usage: run_e2e.py [--scales 1000,10000] [--flows tagger,generate_blacklist] [--output results.json]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib
+import threading
+import traceback
+import subprocess
+from collections import OrderedDict
+try:
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib2 import urlopen, Request
+import synthetic
+import fake_es
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCALES = [1000, 10000]
+JOB_BATCH_SIZE = 500 # job contexts in the list_from_jobs batch
+BLACKLIST_AT = 3
+GREYLIST_AT = 1
+RESULT_FILE = 'result.json'
+LOG_FILE = 'output.log'
+
+def tagger_context(scale, args):
+    return {'location': synthetic.polygon(-180, -90, 180, 90), 'ifg_index': synthetic.INDICES['ifg'],
+            'orbitNumber': synthetic.orbit_number(0), 'aoi_concurrency': args.aoi_concurrency}
+
+def generate_blacklist_context(scale, args):
+    return {'acquisition_list_version': synthetic.ACQ_LIST_VERSION, 'blacklist_at_failure_count': BLACKLIST_AT,
+            'missing_mode': args.missing_mode, 'build_processes': args.build_processes}
+
+def list_from_jobs_context(scale, args):
+    return {'blacklist_at_retry_count': BLACKLIST_AT, 'greylist_at_retry_count': GREYLIST_AT,
+            'job_contexts': [synthetic.job_context(i) for i in synthetic.failed_pairs(scale, JOB_BATCH_SIZE)]}
+
+def blacklist_from_job_context(scale, args):
+    i = [x for x in synthetic.failed_pairs(scale) if synthetic.retry_count(x) >= BLACKLIST_AT][0]
+    ctx = synthetic.job_context(i)
+    ctx['required_retry_count'] = BLACKLIST_AT
+    return ctx
+
+# flow name to the module whose main is run & the builder of its context
+FLOWS = OrderedDict([
+    ('tagger', ('tagger', tagger_context)),
+    ('generate_blacklist', ('generate_blacklist', generate_blacklist_context)),
+    ('list_from_jobs', ('generate_list_from_job', list_from_jobs_context)),
+    ('blacklist_from_job', ('generate_blacklist_from_job', blacklist_from_job_context)),
+])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scales', default=','.join(str(x) for x in SCALES),
+                        help='comma separated numbers of synthetic scene pairs, each about 2.8 documents')
+    parser.add_argument('--flows', default=','.join(FLOWS.keys()))
+    parser.add_argument('--missing-mode', default='scan', choices=['scan', 'terms', 'merge'])
+    parser.add_argument('--build-processes', type=int, default=4)
+    parser.add_argument('--aoi-concurrency', type=int, default=1)
+    parser.add_argument('--output', help='writes the results as json')
+    parser.add_argument('--keep', action='store_true', help='keeps the work directories')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        result = run_flow(args.child, args.url, args.workdir)
+        with open(os.path.join(args.workdir, RESULT_FILE), 'w') as fout:
+            json.dump(result, fout)
+        return
+    flows = args.flows.split(',')
+    for flow in flows:
+        if flow not in FLOWS:
+            raise Exception('unknown flow {0}, expected one of {1}'.format(flow, ', '.join(FLOWS)))
+    results = []
+    for scale in [int(x) for x in args.scales.split(',')]:
+        server, url = start_server(scale)
+        try:
+            for flow in flows:
+                result = run_benchmark(flow, scale, url, args)
+                print_result(result)
+                results.append(result)
+        finally:
+            server.terminate()
+            server.wait()
+    print('\n{0:<20} {1:>9} {2:>10} {3:>9} {4:>11}  {5}'.format('flow', 'scale', 'wall time', 'requests', 'peak rss', 'status'))
+    for result in results:
+        print_result(result)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+def print_result(result):
+    print('{0:<20} {1:>9} {2:>9.2f}s {3:>9} {4:>9.1f}MB  {5}'.format(
+        result['flow'], result['scale'], result.get('wall_time') or 0, result.get('requests', 0),
+        result.get('peak_rss_mb') or 0, result.get('error') or 'ok'))
+
+def start_server(scale):
+    '''starts fake_es.py over the scale, returning the process & its url once it is listening'''
+    print('Starting fake GRQ/Mozart with {0} scene pairs...'.format(scale))
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_es.py'), '--scale', str(scale)],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    for line in iter(server.stdout.readline, ''):
+        print('[fake_es] {0}'.format(line.rstrip()))
+        if line.startswith('listening on '):
+            url = 'http://127.0.0.1:{0}'.format(int(line.split()[-1]))
+            break
+    else:
+        raise Exception('fake_es exited with code {0}'.format(server.wait()))
+    drain = threading.Thread(target=lambda: [print('[fake_es] {0}'.format(x.rstrip())) for x in iter(server.stdout.readline, '')])
+    drain.daemon = True
+    drain.start()
+    return server, url
+
+def call(url, body=None):
+    '''sends a control request to the fake server & returns the parsed response'''
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    return json.loads(urlopen(Request(url, data=data)).read().decode('utf-8'))
+
+def run_benchmark(flow, scale, url, args):
+    '''runs the flow against the freshly reset fake server in a new process & work directory'''
+    call(url + '/_bench/reset', {})
+    workdir = tempfile.mkdtemp(prefix='spv_bench_{0}_'.format(flow))
+    with open(os.path.join(workdir, '_context.json'), 'w') as fout:
+        json.dump(FLOWS[flow][1](scale, args), fout)
+    shutil.copy(os.path.join(REPO_DIR, 'datasets.example.json'), os.path.join(workdir, 'datasets.json'))
+    env = dict(os.environ)
+    env.update({'ES_CACHE_DIR': '', 'BLOOM_FILTER_DIR': os.path.join(workdir, 'bloom'), 'HASH_INDEX_DB': os.path.join(workdir, 'hash_index.db'),
+                'PYTHONPATH': os.pathsep.join([workdir, REPO_DIR] + [x for x in [os.environ.get('PYTHONPATH')] if x])})
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', flow, '--url', url, '--workdir', workdir]
+    with open(os.path.join(workdir, LOG_FILE), 'w') as log:
+        code = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=workdir)
+    result = {'flow': flow, 'scale': scale}
+    if os.path.exists(os.path.join(workdir, RESULT_FILE)):
+        with open(os.path.join(workdir, RESULT_FILE), 'r') as fin:
+            result.update(json.load(fin))
+    else:
+        result['error'] = 'exited with code {0}, see {1}'.format(code, os.path.join(workdir, LOG_FILE))
+    stats = call(url + '/_bench/stats')
+    result['requests'] = stats['requests']
+    result['endpoints'] = stats['endpoints']
+    if args.keep or result.get('error'):
+        result['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir)
+    return result
+
+def run_flow(flow, url, workdir):
+    '''runs the flow's main in this process, against the fake server at the url'''
+    with open(os.path.join(workdir, 'celeryconfig.py'), 'w') as fout:
+        fout.write(celery_config(url))
+    from hysds.celery import app
+    app.conf.update(JOBS_ES_URL=url + fake_es.JOBS_PREFIX, MOZART_URL=url + fake_es.MOZART_PREFIX + '/',
+                    GRQ_UPDATE_URL=url + fake_es.INGEST_PATH)
+    import es_client
+    import metrics
+    import list_product
+    # es_client rewrites GRQ_ES_URL to the https GRQ proxy, so the local base is set directly
+    es_client._BASE_URLS['grq'] = url + fake_es.GRQ_PREFIX
+    list_product.submit_product = ingest
+    module = importlib.import_module(FLOWS[flow][0])
+    error = None
+    start = time.time()
+    try:
+        metrics.run(module.main)
+    except Exception as err:
+        traceback.print_exc()
+        error = '{0}: {1}'.format(type(err).__name__, err)
+    wall_time = time.time() - start
+    return {'wall_time': wall_time, 'peak_rss_mb': peak_rss_mb(), 'client': metrics.summary()['total'], 'error': error}
+
+def celery_config(url):
+    '''the hysds celery settings pointing GRQ & Mozart at the fake server'''
+    return ('GRQ_ES_URL = {0!r}\nJOBS_ES_URL = {1!r}\nMOZART_URL = {2!r}\nGRQ_UPDATE_URL = {3!r}\n'
+            'DATASET_PROCESSED_QUEUE = "dataset_processed"\n').format(
+                url + fake_es.GRQ_PREFIX, url + fake_es.JOBS_PREFIX, url + fake_es.MOZART_PREFIX + '/', url + fake_es.INGEST_PATH)
+
+def ingest(ds):
+    '''
+    Stands in for list_product.submit_product, which ingests through hysds to S3 & GRQ, by
+    posting the built product to the fake GRQ_UPDATE_URL. Posts outside the shared es_client
+    session, as it runs in the build processes.
+    '''
+    import requests
+    import list_product
+    from hysds.celery import app
+    label = ds['label']
+    ds_dir = os.path.join(os.getcwd(), label)
+    with open(os.path.join(ds_dir, '{0}.met.json'.format(label)), 'r') as fin:
+        met = json.load(fin)
+    list_type = [name for name, cfg in list_product.LIST_TYPES.items() if label.startswith(cfg['prefix'] + '-')][0]
+    index = list_product.LIST_TYPES[list_type]['index'].replace('*', 'v1.0')
+    source = {'starttime': ds['starttime'], 'endtime': ds['endtime'], 'location': ds['location'], 'metadata': met,
+              'creation_timestamp': time.strftime(synthetic.TIME_FORMAT, time.gmtime())}
+    body = {'index': index, 'type': list_type, 'id': label, 'source': source}
+    requests.post(app.conf.GRQ_UPDATE_URL, data=json.dumps(body)).raise_for_status()
+    shutil.rmtree(ds_dir)
+
+def peak_rss_mb():
+    '''the peak RSS of this process or of the largest of its finished children, eg build processes'''
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+'''
+Deterministic synthetic GRQ & Mozart documents for the benchmarks. Each scene pair i
+of a scale yields an acq-list & ifg-cfg, & depending on i an ifg, a blacklist or
+greylist product & a failed topsapp job. Scene ids match scene_key.STARTTIME_REGEX.
+'''
+
+from __future__ import print_function
+import json
+import hashlib
+import datetime
+
+ACQ_LIST_VERSION = 'v2.0.0'
+INDICES = {
+    'acq-list': 'grq_v2.0.0_s1-gunw-acq-list',
+    'ifg': 'grq_v2.0_s1-gunw',
+    'ifg-cfg': 'grq_v2.0_s1-gunw-ifg-cfg',
+    'blacklist': 'grq_v1.0_s1-gunw-blacklist',
+    'ifg-blacklist': 'grq_v1.0_s1-gunw-ifg-blacklist',
+    'greylist': 'grq_v1.0_s1-gunw-greylist',
+    'aoi': 'grq_v1.0_area_of_interest',
+    'jobs': 'job_status-current',
+}
+START = datetime.datetime(2017, 1, 1)
+CREATED = datetime.datetime(2019, 1, 1)
+PAIRS_PER_AOI = 1000
+MAX_AOIS = 50
+PAIRS_PER_ORBIT = 500 # pairs sharing an orbitNumber, & so evaluated together by the tagger
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def has_ifg(i):
+    '''70% of pairs have an ifg'''
+    return i % 10 < 7
+
+def is_blacklisted(i):
+    '''5% of pairs, all without an ifg & on odd orbit groups, have a blacklist product. The
+    tagger so finds no blacklist on the first orbit group & matches it against the ifgs'''
+    return i % 10 == 7 and (i // PAIRS_PER_ORBIT) % 2 == 1
+
+def is_greylisted(i):
+    '''2% of pairs, all without an ifg, have a greylist product'''
+    return i % 50 == 8
+
+def retry_count(i):
+    '''the retry_count of the failed job of the pair, 0 if it has none. 20% of pairs have one'''
+    if i % 10 not in (8, 9):
+        return 0
+    return 1 + (i // 10) % 5
+
+def stores_hash(i):
+    '''90% of products store their full_id_hash, the rest are hashed from their scenes'''
+    return i % 10 != 6
+
+def num_aois(scale):
+    return max(1, min(MAX_AOIS, scale // PAIRS_PER_AOI))
+
+def orbit_number(i):
+    '''the [master, slave] orbitNumber of the pair'''
+    orbit = 2 * (i // PAIRS_PER_ORBIT) + 1
+    return [orbit, orbit + 1]
+
+def scene_id(start, absolute_orbit):
+    '''returns an S1 SLC id starting at the datetime'''
+    end = start + datetime.timedelta(seconds=27)
+    return 'S1A_IW_SLC__1SDV_{0}_{1}_{2:06d}_{3:06X}_{4:04X}'.format(
+        start.strftime('%Y%m%dT%H%M%S'), end.strftime('%Y%m%dT%H%M%S'), absolute_orbit, absolute_orbit * 7 % 0xFFFFFF, absolute_orbit % 0xFFFF)
+
+def scenes(i):
+    '''returns the (master, slave) scene id lists of the pair, unique to it by starttime'''
+    master_start = START + datetime.timedelta(minutes=i)
+    slave_start = master_start - datetime.timedelta(days=24)
+    master = [scene_id(master_start + datetime.timedelta(seconds=25 * n), 10000 + i) for n in range(2)]
+    slave = [scene_id(slave_start + datetime.timedelta(seconds=25 * n), 5000 + i) for n in range(2)]
+    return master, slave
+
+def full_id_hash(master, slave):
+    '''the enumerator hash of the scene lists, as scene_key.direct_hash computes it'''
+    return hashlib.md5(json.dumps([' '.join(sorted(master)), ' '.join(sorted(slave))]).encode('utf8')).hexdigest()
+
+def aoi_bounds(a, scale):
+    '''returns the (min lon, max lon) of the AOI strip'''
+    width = 340.0 / num_aois(scale)
+    return -170 + a * width, -170 + (a + 1) * width
+
+def polygon(min_lon, min_lat, max_lon, max_lat):
+    return {'type': 'polygon', 'coordinates': [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat],
+                                                [min_lon, max_lat], [min_lon, min_lat]]]}
+
+def pair_location(i, scale):
+    '''a 1 degree footprint inside the AOI strip of the pair. Runs of 10 pairs share an AOI,
+    so each AOI holds the same mix of products'''
+    block = i // 10
+    min_lon, max_lon = aoi_bounds(block % num_aois(scale), scale)
+    lon = min_lon + (block // num_aois(scale)) % max(1, int(max_lon - min_lon) - 1)
+    return polygon(lon, 30, lon + 1, 31)
+
+def pair_metadata(i, scale):
+    '''the metadata shared by every product of the pair'''
+    master, slave = scenes(i)
+    met = {'master_scenes': master, 'slave_scenes': slave, 'track_number': i % 175 + 1,
+           'orbitNumber': orbit_number(i), 'orbit_number': orbit_number(i), 'union_geojson': pair_location(i, scale),
+           'starttime': (START + datetime.timedelta(minutes=i) - datetime.timedelta(days=24)).strftime(TIME_FORMAT),
+           'endtime': (START + datetime.timedelta(minutes=i, seconds=52)).strftime(TIME_FORMAT),
+           'master_orbit_file': 'S1A_OPER_AUX_POEORB_OPOD_{0}'.format(i // 1440),
+           'slave_orbit_file': 'S1A_OPER_AUX_POEORB_OPOD_{0}'.format(i // 1440 - 24)}
+    if stores_hash(i):
+        met['full_id_hash'] = full_id_hash(master, slave)
+    return met
+
+def product(i, scale, doc_type, prefix, metadata=None):
+    '''returns the (type, id, _source) of a product of the pair'''
+    met = dict(metadata or pair_metadata(i, scale))
+    source = {'starttime': met['starttime'], 'endtime': met['endtime'], 'location': met['union_geojson'],
+              'creation_timestamp': (CREATED + datetime.timedelta(seconds=i)).strftime(TIME_FORMAT), 'metadata': met}
+    return doc_type, '{0}-{1:08d}'.format(prefix, i), source
+
+def failed_job(i, scale):
+    '''returns the (type, id, _source) of the failed topsapp job of the pair'''
+    master, slave = scenes(i)
+    source = {'status': 'job-failed', 'job': {'retry_count': retry_count(i),
+              'job_info': {'job_payload': {'job_type': 'standard_product-s1gunw-topsapp'}},
+              'params': {'input_metadata': {'master_scenes': master, 'slave_scenes': slave}}}}
+    return 'job', 'standard_product-s1gunw-topsapp-{0:08d}'.format(i), source
+
+def aoi(a, scale):
+    '''returns the (type, id, _source) of the AOI strip'''
+    min_lon, max_lon = aoi_bounds(a, scale)
+    source = {'starttime': '2016-01-01T00:00:00', 'endtime': '2030-01-01T00:00:00',
+              'location': polygon(min_lon, 0, max_lon, 60), 'metadata': {'tags': ['standard_product']}}
+    return 'area_of_interest', 'AOI_bench_{0:03d}'.format(a), source
+
+def documents(scale):
+    '''yields (index, type, id, _source) for every document of the scale'''
+    for a in range(num_aois(scale)):
+        yield (INDICES['aoi'],) + aoi(a, scale)
+    for i in range(scale):
+        met = pair_metadata(i, scale)
+        yield (INDICES['acq-list'],) + product(i, scale, 'acq-list', 'acquisition-list', met)
+        yield (INDICES['ifg-cfg'],) + product(i, scale, 'ifg-cfg', 'ifg-cfg', met)
+        if has_ifg(i):
+            yield (INDICES['ifg'],) + product(i, scale, 'S1-GUNW', 'S1-GUNW', met)
+        if is_blacklisted(i):
+            yield (INDICES['blacklist'],) + product(i, scale, 'S1-GUNW-BLACKLIST', 'S1-GUNW-BLACKLIST', met)
+            yield (INDICES['ifg-blacklist'],) + product(i, scale, 'S1-GUNW-IFG-BLACKLIST', 'S1-GUNW-IFG-BLACKLIST', met)
+        if is_greylisted(i):
+            yield (INDICES['greylist'],) + product(i, scale, 'S1-GUNW-GREYLIST', 'S1-GUNW-GREYLIST', met)
+        if retry_count(i):
+            yield (INDICES['jobs'],) + failed_job(i, scale)
+
+def job_context(i):
+    '''returns the context of a failed topsapp job of the pair, as the from-job flows get it'''
+    master, slave = scenes(i)
+    return {'current_retry_count': retry_count(i), 'master_slcs': master, 'slave_slcs': slave}
+
+def failed_pairs(scale, limit=None):
+    '''returns the pairs with a failed job, up to limit'''
+    pairs = []
+    for i in range(scale):
+        if retry_count(i):
+            pairs.append(i)
+            if limit is not None and len(pairs) >= limit:
+                break
+    return pairs
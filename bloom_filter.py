@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+'''
+Bloom filter over the full_id_hashes of blacklist & greylist products.
+Built by build_list_bloom_filter.py & published as a versioned file on
+the worker directory that the builder, tagger & validator job specs mount.
+Jobs memory map it, so hashes the filter rejects skip the list query.
+'''
+
+from __future__ import print_function
+import os
+import json
+import math
+import mmap
+import struct
+import hashlib
+
+FILTER_DIR = os.environ.get('BLOOM_FILTER_DIR', '/data/work/standard_product_validator/bloom')
+MANIFEST = 'list_bloom_filter.json'
+MAGIC = b'SPVBLOOM1\n'
+FP_RATE = 0.01
+KEEP_VERSIONS = 3
+CHECKPOINT_OVERLAP = '1h' # products created this long before the build are also queried
+
+class BloomFilter(object):
+    '''
+    Bloom filter using double hashing over the md5 of each value. The bits are held
+    in a bytearray when built, or a read only mmap when loaded from a file.
+    '''
+
+    def __init__(self, num_bits, num_hashes, bits=None, offset=0, meta=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.offset = offset
+        self.meta = meta or {}
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate=FP_RATE):
+        '''returns an empty filter sized for capacity values at the given false positive rate'''
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        return cls(num_bits, num_hashes, meta={'capacity': capacity, 'fp_rate': fp_rate})
+
+    def _positions(self, value):
+        '''returns the bit positions of the value'''
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        hash1, hash2 = struct.unpack('<QQ', hashlib.md5(value).digest())
+        hash2 |= 1
+        return [(hash1 + i * hash2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        '''adds the value to the filter'''
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        for pos in self._positions(value):
+            byte = self.bits[self.offset + (pos >> 3)]
+            if not isinstance(byte, int):
+                byte = ord(byte)
+            if not byte & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        '''writes the filter to the path: magic, a json header line, then the bits'''
+        header = dict(self.meta, num_bits=self.num_bits, num_hashes=self.num_hashes)
+        with open(path, 'wb') as fout:
+            fout.write(MAGIC)
+            fout.write(json.dumps(header).encode('utf-8'))
+            fout.write(b'\n')
+            fout.write(bytes(self.bits))
+
+    @classmethod
+    def load(cls, path):
+        '''memory maps the filter file at path'''
+        with open(path, 'rb') as fin:
+            if fin.read(len(MAGIC)) != MAGIC:
+                raise Exception('{} is not a bloom filter file'.format(path))
+            header = json.loads(fin.readline().decode('utf-8'))
+            offset = fin.tell()
+            bits = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(header.pop('num_bits'), header.pop('num_hashes'), bits=bits, offset=offset, meta=header)
+
+def publish(bloom, filter_dir=FILTER_DIR):
+    '''
+    Writes the filter as a new version in filter_dir & atomically points the manifest at
+    it, removing all but the last KEEP_VERSIONS versions. Returns the version.
+    '''
+    if not os.path.exists(filter_dir):
+        os.makedirs(filter_dir)
+    manifest_path = os.path.join(filter_dir, MANIFEST)
+    manifest = {'versions': []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fin:
+            manifest = json.load(fin)
+    version = '{0:06d}'.format(int(manifest['versions'][-1]) + 1 if manifest['versions'] else 1)
+    filename = 'list_bloom_filter-{0}.bin'.format(version)
+    bloom.save(os.path.join(filter_dir, filename))
+    manifest['versions'].append(version)
+    for old in manifest['versions'][:-KEEP_VERSIONS]:
+        old_path = os.path.join(filter_dir, 'list_bloom_filter-{0}.bin'.format(old))
+        if os.path.exists(old_path):
+            os.remove(old_path)
+    manifest['versions'] = manifest['versions'][-KEEP_VERSIONS:]
+    manifest.update({'latest': filename, 'version': version, 'checkpoint': bloom.meta.get('checkpoint')})
+    tmp_path = '{}.tmp'.format(manifest_path)
+    with open(tmp_path, 'w') as fout:
+        json.dump(manifest, fout)
+    os.rename(tmp_path, manifest_path)
+    return version
+
+def load_latest(filter_dir=FILTER_DIR):
+    '''returns the latest published filter, or None if none has been published'''
+    manifest_path = os.path.join(filter_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as fin:
+        manifest = json.load(fin)
+    try:
+        bloom = BloomFilter.load(os.path.join(filter_dir, manifest['latest']))
+    except (IOError, OSError, ValueError) as err:
+        print('unable to load bloom filter {}: {}'.format(manifest.get('latest'), err))
+        return None
+    print('loaded bloom filter version {} with checkpoint {}'.format(manifest['version'], bloom.meta.get('checkpoint')))
+    return bloom
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+'''
+Builds the bloom filter over the full_id_hashes of all blacklist
+& greylist products and publishes it as a new filter version.
+Run on a schedule so consumers only query products created since.
+'''
+
+from __future__ import print_function
+import json
+import es_client
+import scene_key
+import bloom_filter
+import metrics
+
+LIST_IDX = 'grq_*_s1-gunw-blacklist,grq_*_s1-gunw-ifg-blacklist,grq_*_s1-gunw-greylist'
+CAPACITY_HEADROOM = 1.2 # sizes the filter for growth until the next build
+
+def main():
+    '''builds & publishes the blacklist/greylist bloom filter'''
+    ctx = load_context()
+    fp_rate = float(ctx.get('fp_rate') or bloom_filter.FP_RATE)
+    print('Scanning blacklist & greylist products...')
+    with metrics.phase('scan_lists'):
+        hashes, checkpoint = get_list_hashes()
+    print('Found {} blacklist & greylist hashes, latest created {}.'.format(len(hashes), checkpoint))
+    bloom = bloom_filter.BloomFilter.for_capacity(int(len(hashes) * CAPACITY_HEADROOM), fp_rate)
+    for hsh in hashes:
+        bloom.add(hsh)
+    bloom.meta.update({'count': len(hashes), 'checkpoint': checkpoint, 'indices': LIST_IDX})
+    version = bloom_filter.publish(bloom)
+    print('Published bloom filter version {} ({} bits, {} hashes) to {}'.format(version, bloom.num_bits, bloom.num_hashes, bloom_filter.FILTER_DIR))
+
+def get_list_hashes():
+    '''returns the set of full_id_hashes of all list products & their latest creation_timestamp'''
+    grq_url = es_client.grq_url(LIST_IDX, '_search')
+    es_query = {"query":{"match_all":{}}, "_source":scene_key.SOURCE_FIELDS + ['creation_timestamp']}
+    hashes = set()
+    checkpoint = None
+    for hit in es_client.scan(grq_url, es_query):
+        hashes.add(scene_key.from_es_object(hit).full_id_hash)
+        timestamp = hit.get('_source', {}).get('creation_timestamp')
+        if timestamp and timestamp > (checkpoint or ''):
+            checkpoint = timestamp
+    return hashes, checkpoint
+
+def load_context():
+    '''loads the context file into a dict'''
+    try:
+        context_file = '_context.json'
+        with open(context_file, 'r') as fin:
+            context = json.load(fin)
+        return context
+    except:
+        raise Exception('unable to parse _context.json from work directory')
+
+if __name__ == '__main__':
+    metrics.run(main)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+'''
+Shared Elasticsearch client for GRQ & Mozart queries. Holds a single
+pooled keep-alive session and the one pagination implementation used
+by every script in this repo.
+'''
+
+from __future__ import print_function
+import os
+import time
+import gzip
+import json
+import hashlib
+import requests
+import threading
+from collections import OrderedDict
+from io import BytesIO
+import urllib3
+from requests.adapters import HTTPAdapter
+from hysds.celery import app
+import metrics
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# optional faster json decoders, parsing response bytes directly
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+    except ImportError:
+        loads = json.loads
+# optional incremental parser (ijson >= 3.1), used to stream scan pages hit by hit
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+POOL_SIZE = 10
+TIMEOUT = 60
+PAGE_SIZE = 1000
+SCROLL_TIMEOUT = '2m'
+BULK_SIZE = 500
+MSEARCH_SIZE = 50
+COMPRESS_MIN_BYTES = 16 * 1024 # request bodies larger than this are gzipped, None disables
+# seconds query_es results are cached for, per index. Indices not listed are never cached
+CACHE_TTLS = {'grq_*_area_of_interest': 3600, 'grq_*_s1-aux_poeorb': 86400, 'grq_*_s1-gunw-acqlist-audit_trail': 3600}
+CACHE_SIZE = 256 # max cached results held in memory
+# on-disk cache shared by jobs on the worker, on the worker directory the job specs mount. An empty
+# ES_CACHE_DIR, or no mount, disables it
+WORKER_DIR = '/data/work/standard_product_validator'
+CACHE_DIR = os.environ.get('ES_CACHE_DIR', os.path.join(WORKER_DIR, 'es_cache') if os.path.isdir(WORKER_DIR) else None) or None
+CACHE_DISK_SIZE = 1024 # max cached results kept on disk
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_BASE_URLS = {}
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+def get_session():
+    '''returns the shared session, creating the connection pool on first use. Safe to share across threads'''
+    global _SESSION
+    if _SESSION is not None:
+        return _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = False
+            session.headers.update({'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'})
+            _SESSION = session
+    return _SESSION
+
+def grq_base():
+    '''returns the GRQ es endpoint, resolved once from the celery config'''
+    if 'grq' not in _BASE_URLS:
+        grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
+        _BASE_URLS['grq'] = '{0}/es'.format(grq_ip.rstrip('/'))
+    return _BASE_URLS['grq']
+
+def mozart_base():
+    '''returns the Mozart jobs es endpoint, resolved once from the celery config'''
+    if 'mozart' not in _BASE_URLS:
+        _BASE_URLS['mozart'] = app.conf['JOBS_ES_URL'].replace('https://', 'http://').rstrip('/')
+    return _BASE_URLS['mozart']
+
+def grq_url(*parts):
+    '''builds a GRQ url from the given path parts, eg grq_url(index, '_search')'''
+    return '/'.join([grq_base()] + [str(part) for part in parts])
+
+def mozart_url(*parts):
+    '''builds a Mozart jobs url from the given path parts'''
+    return '/'.join([mozart_base()] + [str(part) for part in parts])
+
+def post(url, body, index=None):
+    '''posts the json body to the url over the shared session & returns the parsed response'''
+    return post_data(url, json.dumps(body), index=index)
+
+def post_data(url, data, index=None):
+    '''
+    posts the already serialized body to the url & returns the parsed response. The request
+    is counted in the job metrics against the index, by default the index of the url.
+    '''
+    data, headers = encode_body(data)
+    start = time.time()
+    response = get_session().post(url, data=data, headers=headers, timeout=TIMEOUT)
+    response.raise_for_status()
+    results = loads(response.content)
+    hits = [x.get('hits', {}).get('hits', []) for x in results.get('responses', [results])]
+    metrics.record(index or _index_for(url) or url, requests=1, pages=len([x for x in hits if x]),
+                   hits=sum(len(x) for x in hits), bytes_sent=len(data), bytes_received=len(response.content),
+                   request_time=time.time() - start)
+    return results
+
+def encode_body(data):
+    '''gzips the request body when it is over COMPRESS_MIN_BYTES. Returns the body & extra headers'''
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    if COMPRESS_MIN_BYTES is None or len(data) < COMPRESS_MIN_BYTES:
+        return data, {}
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fout:
+        fout.write(data)
+    return buf.getvalue(), {'Content-Encoding': 'gzip'}
+
+def search(url, es_query):
+    '''runs a single search request & returns the raw response dict'''
+    return post(url, es_query)
+
+def query_es(url, es_query):
+    '''
+    Runs the query through Elasticsearch, iterates until
+    all results are generated, & returns the compiled result.
+    Results over indices in CACHE_TTLS are served from the cache.
+    '''
+    ttl = CACHE_TTLS.get(_index_for(url))
+    if ttl:
+        key = hashlib.md5(json.dumps([url, es_query], sort_keys=True).encode('utf-8')).hexdigest()
+        results = cache_get(key, ttl)
+        if results is not None:
+            return results
+    es_query = _paged(es_query)
+    results = _compile_pages(url, es_query, search(url, es_query))
+    if ttl:
+        cache_put(key, results)
+    return results
+
+def cache_get(key, ttl):
+    '''returns a copy of the cached result under the key if it is younger than ttl seconds, checking
+    memory then the disk cache. Counts the hit or miss'''
+    now = time.time()
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry is not None and now - entry[0] < ttl:
+            _CACHE[key] = _CACHE.pop(key)
+            CACHE_STATS['hits'] += 1
+            return list(entry[1])
+    entry = _disk_get(key)
+    with _CACHE_LOCK:
+        if entry is not None and now - entry[0] < ttl:
+            _cache_store(key, entry)
+            CACHE_STATS['hits'] += 1
+            return list(entry[1])
+        CACHE_STATS['misses'] += 1
+    return None
+
+def cache_put(key, results):
+    '''caches the result under the key in memory & on disk'''
+    entry = (time.time(), list(results))
+    with _CACHE_LOCK:
+        _cache_store(key, entry)
+    _disk_put(key, entry)
+
+def _cache_store(key, entry):
+    '''stores the entry as most recently used, evicting the least recently used over CACHE_SIZE'''
+    _CACHE.pop(key, None)
+    _CACHE[key] = entry
+    while len(_CACHE) > CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+def _disk_get(key):
+    '''returns the (timestamp, result) entry on the disk cache, None if it is not there'''
+    if not CACHE_DIR:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, '{0}.json'.format(key)), 'r') as fin:
+            return tuple(json.load(fin))
+    except (IOError, OSError, ValueError):
+        return None
+
+def _disk_put(key, entry):
+    '''atomically writes the entry to the disk cache & prunes it, ignoring failures'''
+    if not CACHE_DIR:
+        return
+    try:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        path = os.path.join(CACHE_DIR, '{0}.json'.format(key))
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as fout:
+            json.dump(entry, fout)
+        os.rename(tmp_path, path)
+        prune_disk_cache()
+    except (IOError, OSError) as err:
+        print('failed to write es cache: {}'.format(err))
+
+def prune_disk_cache(max_entries=CACHE_DISK_SIZE):
+    '''
+    Removes the disk cache entries older than the longest of CACHE_TTLS, which are expired for
+    every index, & the least recently written entries over max_entries. Entries another job
+    removes first are skipped.
+    '''
+    expired = time.time() - max(CACHE_TTLS.values())
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    for i, (mtime, path) in enumerate(entries):
+        if i >= max_entries or mtime < expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def log_cache_stats():
+    '''prints the cache hit & miss counts'''
+    print('es cache: {} hits, {} misses'.format(CACHE_STATS['hits'], CACHE_STATS['misses']))
+
+def _index_for(url):
+    '''returns the index path part of a search url, None if it is not on a known endpoint'''
+    for base in _BASE_URLS.values():
+        if url.startswith(base + '/'):
+            return url[len(base) + 1:].split('/')[0]
+    return None
+
+def multi_query_es(searches, batch_size=MSEARCH_SIZE):
+    '''
+    Runs the (index, es_query) GRQ searches through _msearch, batch_size searches per
+    request. Only the searches with more hits than their first page are paged further.
+    Returns the compiled result of each search, in order.
+    '''
+    results = []
+    for i in range(0, len(searches), batch_size):
+        batch = [(index, _paged(es_query)) for index, es_query in searches[i:i + batch_size]]
+        lines = []
+        for index, es_query in batch:
+            lines.append(json.dumps({'index': index}))
+            lines.append(json.dumps(es_query))
+        responses = post_data(grq_url('_msearch'), '\n'.join(lines) + '\n').get('responses', [])
+        for (index, es_query), response in zip(batch, responses):
+            if 'error' in response:
+                raise Exception('search over {} failed: {}'.format(index, response['error']))
+            results.append(_compile_pages(grq_url(index, '_search'), es_query, response))
+    return results
+
+def _paged(es_query):
+    '''returns a copy of the query with the from & size fields filled in'''
+    es_query = dict(es_query)
+    es_query.setdefault('size', PAGE_SIZE)
+    es_query.setdefault('from', 0)
+    return es_query
+
+def _compile_pages(url, es_query, results):
+    '''compiles the first page of results with the remaining pages of the query'''
+    page_size = es_query['size']
+    results_list = results.get('hits', {}).get('hits', [])
+    total_count = results.get('hits', {}).get('total', 0)
+    for i in range(es_query['from'] + page_size, total_count, page_size):
+        es_query['from'] = i
+        results = search(url, es_query)
+        results_list.extend(results.get('hits', {}).get('hits', []))
+    return results_list
+
+def scan(url, es_query, page_size=PAGE_SIZE, scroll=SCROLL_TIMEOUT, sort=None):
+    '''
+    Streams every hit matching the query using a scroll sorted on _doc (or the
+    given sort), yielding hits one page at a time instead of compiling a list.
+    Avoids the from/size result window limit & deep pagination costs.
+    '''
+    es_query = dict(es_query)
+    es_query.pop('from', None)
+    es_query['size'] = page_size
+    es_query['sort'] = sort or ['_doc']
+    page_url, body = '{0}?scroll={1}'.format(url, scroll), es_query
+    meta = {}
+    index = _index_for(url)
+    try:
+        while True:
+            count = 0
+            for hit in post_hits(page_url, body, meta, index=index):
+                count += 1
+                yield hit
+            if not count or meta.get('_scroll_id') is None:
+                break
+            page_url, body = scroll_url(url), {'scroll': scroll, 'scroll_id': meta['_scroll_id']}
+    finally:
+        if meta.get('_scroll_id') is not None:
+            clear_scroll(url, meta['_scroll_id'])
+
+def post_hits(url, body, meta, index=None):
+    '''
+    Posts the json body & yields the hits.hits entries of the response. With ijson installed
+    the hits are parsed one at a time from the response stream, so a page is never held whole.
+    The _scroll_id & hits.total of the response are recorded in meta.
+    '''
+    if ijson is None:
+        results = post(url, body, index=index)
+        meta['_scroll_id'] = results.get('_scroll_id', meta.get('_scroll_id'))
+        meta['total'] = results.get('hits', {}).get('total', 0)
+        for hit in results.get('hits', {}).get('hits', []):
+            yield hit
+        return
+    data, headers = encode_body(json.dumps(body))
+    start = time.time()
+    response = get_session().post(url, data=data, headers=headers, timeout=TIMEOUT, stream=True)
+    count = 0
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for hit in parse_hits(response.raw, meta):
+            count += 1
+            yield hit
+    finally:
+        response.close()
+        metrics.record(index or _index_for(url) or url, requests=1, pages=1 if count else 0, hits=count,
+                       bytes_sent=len(data), bytes_received=response.raw.tell(), request_time=time.time() - start)
+
+def parse_hits(stream, meta):
+    '''incrementally parses a search response from the byte stream, yielding each hits.hits entry'''
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'hits.hits.item' and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif prefix == 'hits.hits.item' and event == 'start_map':
+            builder = ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == '_scroll_id' and event == 'string':
+            meta['_scroll_id'] = value
+        elif prefix == 'hits.total' and event == 'number':
+            meta['total'] = value
+
+def scroll_url(url):
+    '''returns the scroll endpoint on the same host as the given search url'''
+    return '{0}/_search/scroll'.format(_base_for(url))
+
+def clear_scroll(url, scroll_id):
+    '''releases the server side scroll context, ignoring failures'''
+    try:
+        get_session().delete(scroll_url(url), data=json.dumps({'scroll_id': [scroll_id]}), timeout=TIMEOUT)
+    except requests.exceptions.RequestException as err:
+        print('failed to clear scroll: {}'.format(err))
+
+def _base_for(url):
+    '''returns the GRQ or Mozart base that the url was built from'''
+    for base in _BASE_URLS.values():
+        if url.startswith(base):
+            return base
+    raise Exception('unable to determine es endpoint for url: {}'.format(url))
+
+def bulk(url, actions, batch_size=BULK_SIZE):
+    '''
+    Sends (action, body) pairs to the _bulk endpoint in batches of batch_size. Returns
+    the response items that failed, an empty list if all succeeded.
+    '''
+    failed = []
+    batch = []
+    count = 0
+    for action, body in actions:
+        batch.append(json.dumps(action))
+        if body is not None:
+            batch.append(json.dumps(body))
+        count += 1
+        if count >= batch_size:
+            failed.extend(_send_bulk(url, batch))
+            batch = []
+            count = 0
+    if batch:
+        failed.extend(_send_bulk(url, batch))
+    return failed
+
+def _send_bulk(url, lines):
+    '''posts one batch of ndjson lines to the _bulk endpoint & returns the failed items'''
+    results = post_data(url, '\n'.join(lines) + '\n')
+    if not results.get('errors', False):
+        return []
+    failed = []
+    for item in results.get('items', []):
+        status = list(item.values())[0]
+        if status.get('error'):
+            failed.append(status)
+    return failed
+
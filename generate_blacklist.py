@@ -7,14 +7,31 @@ Queries ES for ifg config files. Determines if products
 '''
 
 from __future__ import print_function
-import re
+import os
 import json
-import pickle
-import hashlib
-import requests
-from hysds.celery import app
+import heapq
+import tempfile
+import es_client
+import scene_key
+import hash_index
+import bloom_filter
+import metrics
 import build_blacklist_product
 
+IFG_IDX = 'grq_*_s1-gunw'
+ACQ_LIST_IDX = 'grq_{0}_s1-gunw-acq-list'
+BLACKLIST_IDX = 'grq_*_s1-gunw-ifg-blacklist'
+PRODUCED_IDX = ','.join([IFG_IDX, BLACKLIST_IDX]) # acq-lists with a product in either are not missing
+TERMS_CHUNK_SIZE = 1000
+EXTERNAL_SORT_RUN_SIZE = 100000
+# incremental state, holding the latest creation_timestamp per index & the missing acq-lists. Kept on the
+# worker directory the validator job spec mounts, so it outlives the job container
+STATE_FILE = '/data/work/standard_product_validator/generate_blacklist_state.json'
+CHECKPOINT_OVERLAP = '1h'
+# _source fields needed to match failed jobs
+JOB_FIELDS = ['job.params.input_metadata.master_scenes', 'job.params.input_metadata.slave_scenes',
+              'job.params.input_metadata.reference_scenes', 'job.params.input_metadata.secondary_scenes']
+
 def main():
     '''
     Determines all missing ifgs that have ifgs configs and are
@@ -26,17 +43,285 @@ def main():
     ctx = load_context()
     acq_list_version = ctx['acquisition_list_version']
     count_to_blacklist = ctx['blacklist_at_failure_count']
-    acq_lists = build_hashed_dict(get_acq_lists(acq_list_version))
-    ifgs = build_hashed_dict(get_ifgs())
-    blacklist = build_hashed_dict(get_blacklist())
-    print('Found {} acq-lists, {} ifgs, and {} blacklist products.'.format(len(acq_lists.keys()), len(ifgs.keys()), len(blacklist.keys())))
-    print('Determining missing IFGs...')
-    missing = determine_missing_ifgs(acq_lists, ifgs, blacklist)
+    incremental = get_flag(ctx, 'incremental')
+    state_file = ctx.get('state_file') or STATE_FILE
+    hash_index.get_index(ctx.get('hash_index_db'))
+    state = None
+    if incremental and not get_flag(ctx, 'full_rebuild'):
+        state = load_state(state_file, acq_list_version)
+    if state is None:
+        state = {'acquisition_list_version': acq_list_version, 'checkpoints': {}, 'missing': {}}
+        missing_mode = ctx.get('missing_mode', 'scan')
+        if missing_mode == 'terms':
+            print('Looking up acq-list hashes on the ifg & blacklist indices...')
+            with metrics.phase('determine_missing'):
+                missing = determine_all_missing_by_terms(state)
+        elif missing_mode == 'merge':
+            print('Merging hash sorted acq-list, ifg & blacklist products...')
+            with metrics.phase('determine_missing'):
+                missing = determine_all_missing_by_merge(state)
+        else:
+            print('Scanning all products...')
+            with metrics.phase('determine_missing'):
+                missing = determine_all_missing(state)
+    else:
+        print('Scanning products created since {}...'.format(state['checkpoints']))
+        with metrics.phase('determine_missing'):
+            missing = determine_new_missing(state)
     print('Found {} missing IFGs. Checking jobs.'.format(len(missing)))
-    add_to_blacklist = determine_failed(missing, count_to_blacklist) #returns a list of acq-list objects that are associated with failed jobs
+    state['missing'] = dict((scene_key.from_es_object(obj).full_id_hash, obj) for obj in missing)
+    if incremental:
+        save_state(state_file, state)
+    with metrics.phase('determine_failed'):
+        add_to_blacklist = determine_failed(missing, count_to_blacklist) #returns a list of acq-list objects that are associated with failed jobs
     print('{} jobs have failed {} times or more. Adding each as a blacklist product...'.format(len(add_to_blacklist), count_to_blacklist))
-    for item in add_to_blacklist:
-        build_blacklist_product.build(item)
+    processes = int(ctx.get('build_processes', build_blacklist_product.BUILD_PROCESSES))
+    with metrics.phase('get_full_objects'):
+        full_objects = get_full_objects(add_to_blacklist, build_blacklist_product.SOURCE_FIELDS)
+    if not full_objects:
+        return
+    results = build_blacklist_product.build_many(full_objects, processes)
+    failed = [label for label, error in results if error]
+    if failed:
+        raise Exception('failed to build {} of {} blacklist products: {}'.format(len(failed), len(results), ', '.join(failed)))
+
+def determine_all_missing(state):
+    '''
+    Determines the missing ifgs from a full scan of the acq-list, ifg & blacklist indices,
+    recording the latest creation_timestamp of each under the state checkpoints. When a list
+    bloom filter is published, only the blacklist products created since it was built are
+    scanned, & the missing ifgs the filter can not rule out are confirmed on ES.
+    '''
+    checkpoints = state['checkpoints']
+    bloom = bloom_filter.load_latest()
+    since = bloom.meta.get('checkpoint') if bloom is not None else None
+    if since:
+        checkpoints['blacklist'] = since
+    ifgs = build_hash_set(track_checkpoint(get_ifgs(), checkpoints, 'ifg'))
+    blacklist = build_hash_set(track_checkpoint(get_blacklist(since), checkpoints, 'blacklist'))
+    print('Found {} ifgs and {} blacklist products.'.format(len(ifgs), len(blacklist)))
+    print('Determining missing IFGs...')
+    acq_lists = track_checkpoint(get_acq_lists(state['acquisition_list_version']), checkpoints, 'acq-list')
+    missing = determine_missing_ifgs(acq_lists, ifgs, blacklist)
+    if since:
+        missing = filter_blacklisted(missing, bloom)
+    return missing
+
+def filter_blacklisted(acq_lists, bloom):
+    '''
+    Returns the acq-lists that are not blacklisted, only confirming on ES those that the
+    bloom filter can not rule out. Acq-lists without a stored full_id_hash are always
+    confirmed, as their computed hash need not be the one the blacklist product holds.
+    The confirmed acq-lists are matched on scenes against the unhashed blacklist products,
+    or every blacklist product if any confirmed acq-list is unhashed, then looked up by hash.
+    '''
+    keys = [scene_key.from_es_object(obj) for obj in acq_lists]
+    confirm = [i for i, key in enumerate(keys) if not key.stored_hash or key.stored_hash in bloom]
+    print('Bloom filter ruled out {} of {} missing IFGs, confirming the rest on ES.'.format(len(keys) - len(confirm), len(keys)))
+    if any(not keys[i].stored_hash for i in confirm):
+        blacklist = build_hash_set(get_blacklist())
+    else:
+        blacklist = get_unhashed_products(BLACKLIST_IDX)
+    blacklisted = set(i for i in confirm if keys[i] in blacklist)
+    confirm = [i for i in confirm if i not in blacklisted]
+    existing = find_existing_hashes_on_es(BLACKLIST_IDX, [keys[i].full_id_hash for i in confirm])
+    blacklisted.update(i for i in confirm if keys[i].full_id_hash in existing)
+    return [obj for i, obj in enumerate(acq_lists) if i not in blacklisted]
+
+def determine_all_missing_by_terms(state):
+    '''
+    Determines the missing ifgs by streaming the acq-lists & looking up their hashes on
+    the ifg & blacklist indices, so only acq-lists & matched hashes reach the client.
+    The ifg & blacklist products with no stored full_id_hash, which the lookups can not
+    match, are scanned & matched locally as in scan mode. Checkpoints for the ifg &
+    blacklist indices are taken from their latest timestamp.
+    '''
+    checkpoints = state['checkpoints']
+    for name, index in (('ifg', IFG_IDX), ('blacklist', BLACKLIST_IDX)):
+        latest = get_latest_timestamp(index)
+        if latest:
+            checkpoints[name] = latest
+    unhashed = get_unhashed_products()
+    print('Found {} ifg and blacklist products without a full_id_hash.'.format(len(unhashed)))
+    acq_lists = track_checkpoint(get_acq_lists(state['acquisition_list_version']), checkpoints, 'acq-list')
+    return determine_missing_by_terms(acq_lists, unhashed)
+
+def determine_missing_by_terms(acq_lists, unhashed, chunk_size=TERMS_CHUNK_SIZE):
+    '''
+    Determines the acq-lists that have no ifg or blacklist product, matching them against
+    the unhashed products & looking up the hashes of each chunk of chunk_size acq-lists
+    on the ifg & blacklist indices.
+    '''
+    missing = {}
+    chunk = {}
+    count = 0
+    for acq_list in acq_lists:
+        count += 1
+        chunk[scene_key.from_es_object(acq_list).full_id_hash] = acq_list
+        if len(chunk) >= chunk_size:
+            missing.update(filter_existing(chunk, unhashed))
+            chunk = {}
+    if chunk:
+        missing.update(filter_existing(chunk, unhashed))
+    print('Checked {} acq-lists.'.format(count))
+    return list(missing.values())
+
+def filter_existing(acq_lists_by_hash, unhashed):
+    '''
+    Returns the entries of the hash to acq-list dict that have no ifg or blacklist product.
+    Acq-lists matching a product of the unhashed KeyIndex are dropped before the rest are
+    looked up on ES by hash.
+    '''
+    remaining = dict((hsh, obj) for hsh, obj in acq_lists_by_hash.items() if scene_key.from_es_object(obj) not in unhashed)
+    existing = find_existing_hashes(PRODUCED_IDX, remaining.keys())
+    return dict((hsh, obj) for hsh, obj in remaining.items() if hsh not in existing)
+
+def get_unhashed_products(index=PRODUCED_IDX):
+    '''
+    Returns a scene_key.KeyIndex of the products of the index, by default the ifg & blacklist
+    indices, with no stored full_id_hash, which hash lookups on ES can not match
+    '''
+    grq_url = es_client.grq_url(index, '_search')
+    es_query = {"query":{"filtered":{"filter":{"missing":{"field":"metadata.full_id_hash"}}}}, "_source":scene_key.SOURCE_FIELDS}
+    return build_hash_set(es_client.scan(grq_url, es_query))
+
+def determine_all_missing_by_merge(state):
+    '''
+    Determines the missing ifgs with a merge join over the acq-list, ifg & blacklist
+    indices streamed in hash order, holding only the missing acq-lists in memory. The
+    unhashed products of all three are sorted before any hash sorted scroll is opened.
+    '''
+    checkpoints = state['checkpoints']
+    acq_list_idx = ACQ_LIST_IDX.format(state['acquisition_list_version'])
+    for name, index in (('acq-list', acq_list_idx), ('ifg', IFG_IDX), ('blacklist', BLACKLIST_IDX)):
+        latest = get_latest_timestamp(index)
+        if latest:
+            checkpoints[name] = latest
+    acq_lists = sorted_products(acq_list_idx, keep_objects=True)
+    produced = merge_sorted(sorted_products(IFG_IDX), sorted_products(BLACKLIST_IDX))
+    return merge_missing(acq_lists, produced)
+
+def merge_missing(acq_lists, produced):
+    '''
+    Returns the acq-lists with no produced hash. Both are (hash, object) streams sorted by
+    hash, so they are walked once in step.
+    '''
+    missing = []
+    count = 0
+    last_hash = None
+    produced_hash = next(produced, (None, None))[0]
+    for hsh, acq_list in acq_lists:
+        count += 1
+        if hsh == last_hash:
+            continue
+        last_hash = hsh
+        while produced_hash is not None and produced_hash < hsh:
+            produced_hash = next(produced, (None, None))[0]
+        if produced_hash != hsh:
+            missing.append(acq_list)
+    print('Checked {} acq-lists.'.format(count))
+    return missing
+
+def sorted_products(index, keep_objects=False):
+    '''
+    Returns a stream of (full_id_hash, object) pairs of the index in hash order. Products with
+    a stored full_id_hash are sorted by ES, the rest are hashed locally & sorted on disk. The
+    unhashed products are scanned & sorted before returning, while the hash sorted scroll is
+    only opened once the stream is read, so it never idles past the scroll timeout behind a
+    scan. The object is None unless keep_objects is set.
+    '''
+    grq_url = es_client.grq_url(index, '_search')
+    without_hash = {"query":{"filtered":{"filter":{"missing":{"field":"metadata.full_id_hash"}}}}, "_source":scene_key.SOURCE_FIELDS}
+    hits = es_client.scan(grq_url, without_hash)
+    local = external_sort((scene_key.from_es_object(hit).full_id_hash, hit if keep_objects else None) for hit in hits)
+    fields = scene_key.SOURCE_FIELDS if keep_objects else ['metadata.full_id_hash']
+    with_hash = {"query":{"filtered":{"filter":{"exists":{"field":"metadata.full_id_hash"}}}}, "_source":fields}
+    hits = es_client.scan(grq_url, with_hash, sort=[{"metadata.full_id_hash.raw":"asc"}])
+    stored = ((hit['_source']['metadata']['full_id_hash'], hit if keep_objects else None) for hit in hits)
+    return merge_sorted(stored, local)
+
+def merge_sorted(*streams):
+    '''merges (hash, object) streams that are each sorted by hash into one sorted stream'''
+    for hsh, _, _, obj in heapq.merge(*[_sort_keyed(stream, i) for i, stream in enumerate(streams)]):
+        yield hsh, obj
+
+def _sort_keyed(stream, stream_id):
+    '''keys the (hash, object) stream so merging never compares the objects themselves'''
+    for seq, (hsh, obj) in enumerate(stream):
+        yield hsh, stream_id, seq, obj
+
+def external_sort(records, run_size=EXTERNAL_SORT_RUN_SIZE):
+    '''
+    Sorts a (hash, object) stream by hash, consuming it before returning the sorted stream.
+    Sorted runs of run_size records are written to temporary files, which are merged back
+    by the returned stream & removed once it is consumed.
+    '''
+    run_files = []
+    run = []
+    try:
+        for record in records:
+            run.append(record)
+            if len(run) >= run_size:
+                run_files.append(_write_run(run))
+                run = []
+        if run_files and run:
+            run_files.append(_write_run(run))
+    except:
+        _remove_runs(run_files)
+        raise
+    if not run_files:
+        return iter(sorted(run, key=lambda record: record[0]))
+    return _merge_runs(run_files)
+
+def _merge_runs(run_files):
+    '''streams the records of the sorted run files in hash order, removing the files once consumed'''
+    try:
+        for record in merge_sorted(*[_read_run(run_file) for run_file in run_files]):
+            yield record
+    finally:
+        _remove_runs(run_files)
+
+def _remove_runs(run_files):
+    for run_file in run_files:
+        if os.path.exists(run_file):
+            os.remove(run_file)
+
+def _write_run(run):
+    '''writes the records sorted by hash to a temporary file, one json record per line'''
+    handle, run_file = tempfile.mkstemp(prefix='generate_blacklist_', suffix='.run')
+    with os.fdopen(handle, 'w') as fout:
+        for record in sorted(run, key=lambda record: record[0]):
+            fout.write(json.dumps(record))
+            fout.write('\n')
+    return run_file
+
+def _read_run(run_file):
+    '''streams the (hash, object) records of a run file'''
+    with open(run_file, 'r') as fin:
+        for line in fin:
+            hsh, obj = json.loads(line)
+            yield hsh, obj
+
+def determine_new_missing(state):
+    '''
+    Determines the missing ifgs from the products created since the state checkpoints.
+    Previously missing acq-lists are dropped once a new ifg or blacklist product matches
+    them, & new acq-lists are checked against the full ifg & blacklist indices by hash, &
+    against their unhashed products locally.
+    '''
+    checkpoints = state['checkpoints']
+    ifgs = build_hash_set(track_checkpoint(get_ifgs(checkpoints.get('ifg')), checkpoints, 'ifg'))
+    blacklist = build_hash_set(track_checkpoint(get_blacklist(checkpoints.get('blacklist')), checkpoints, 'blacklist'))
+    print('Found {} new ifgs and {} new blacklist products.'.format(len(ifgs), len(blacklist)))
+    print('Determining missing IFGs...')
+    acq_lists = list(state['missing'].values())
+    acq_lists.extend(track_checkpoint(get_acq_lists(state['acquisition_list_version'], checkpoints.get('acq-list')), checkpoints, 'acq-list'))
+    candidates = determine_missing_ifgs(acq_lists, ifgs, blacklist)
+    hashes = [scene_key.from_es_object(obj).full_id_hash for obj in candidates]
+    new = dict((hsh, obj) for hsh, obj in zip(hashes, candidates) if hsh not in state['missing'])
+    if new:
+        new = filter_existing(new, get_unhashed_products())
+    return [obj for hsh, obj in zip(hashes, candidates) if hsh in state['missing'] or hsh in new]
 
 def determine_failed(missing, count_to_blacklist):
     '''
@@ -44,123 +329,177 @@ def determine_failed(missing, count_to_blacklist):
     blacklist, have failed more than count_to_blacklist times. Returns those
     acq-list products. Param missing is the acq-list ES object list.
     '''
-    mozart_ip = app.conf['JOBS_ES_URL'].replace('https://', 'http://').rstrip('/')
-    mozart_url = '{0}/job_status-current/_search'.format(mozart_ip)
-
-    #es_query = {"query":{"bool":{"must":[{"term":{"status":"job-failed"}},{"term":{"job.job_info.job_payload.job_type":"job-sciflo-s1-ifg"}},{"range":{"job.retry_count":{"gte":count_to_blacklist}}}]}},"from":0,"size":1000}
-    if count_to_blacklist > 0:
-        es_query = {"query":{"bool":{"must":[{"term":{"status":"job-failed"}},{"term":{"job.job_info.job_payload.job_type":"standard_product-s1gunw-topsapp"}},{"range":{"job.retry_count":{"gte":count_to_blacklist}}}]}},"from":0,"size":1000}
-    else:
-        es_query = {"query":{"bool":{"must":[{"term":{"job.job_info.job_payload.job_type":"standard_product-s1gunw-topsapp"}},{"term":{"status":"job-failed"}}],"must_not":[],"should":[]}},"from":0,"size":1000,"sort":[],"aggs":{}}
-    all_failed = query_es(mozart_url, es_query)
-    print('----------------------------------\nall failed jobs: {}\n-------------------------------'.format(all_failed))
-    all_failed_dict = build_hashed_dict(all_failed)
+    failed = get_failed_jobs(count_to_blacklist)
+    print('Found failed jobs for {} scene pairs.'.format(len(failed)))
     add_to_blacklist = []
     for acq_list in missing:
-        if is_in(acq_list, all_failed_dict):
+        if is_in(acq_list, failed):
             add_to_blacklist.append(acq_list)
     return add_to_blacklist
 
-def is_in(ifg_cfg, all_failed_dict):
+def get_failed_jobs(count_to_blacklist):
     '''
-    Returns True if the ifg_cfg object is inside the failed_job_list. False otherwise.
+    Returns the set of pair_hashes of the master/slave scene params of the failed topsapp
+    jobs retried at least count_to_blacklist times. Only the scene params are fetched.
     '''
-    ifg_cfg_hash = gen_hash(ifg_cfg)
-    if all_failed_dict.get(ifg_cfg_hash):
-        return True
-    return False
+    mozart_url = es_client.mozart_url('job_status-current', '_search')
+    must = [{"term":{"status":"job-failed"}}, {"term":{"job.job_info.job_payload.job_type":"standard_product-s1gunw-topsapp"}}]
+    if count_to_blacklist > 0:
+        must.append({"range":{"job.retry_count":{"gte":count_to_blacklist}}})
+    es_query = {"query":{"bool":{"must":must}}, "_source":JOB_FIELDS}
+    failed = set()
+    for job in es_client.scan(mozart_url, es_query):
+        key = job_scene_key(job)
+        if key is not None:
+            failed.add(key.pair_hash)
+    return failed
+
+def job_scene_key(job):
+    '''returns the SceneKey of the job's master/slave scene params, None if it has none'''
+    met = job.get('_source', {}).get('job', {}).get('params', {}).get('input_metadata', {})
+    master = met.get('master_scenes', met.get('reference_scenes'))
+    slave = met.get('slave_scenes', met.get('secondary_scenes'))
+    if not master or not slave:
+        return None
+    return scene_key.from_scenes(master, slave)
+
+def is_in(ifg_cfg, failed):
+    '''
+    Returns True if the ifg_cfg object has a failed job in the failed job pair_hash set. False otherwise.
+    '''
+    return scene_key.from_es_object(ifg_cfg).pair_hash in failed
 
 def determine_missing_ifgs(acq_lists, ifgs, blacklist):
     '''
     Determines the ifgs that have not been produced from the acquisition lists.
+    Consumes the acq_lists stream, only holding on to the missing acq-lists.
     '''
-    missing = []
-    for key in acq_lists.keys():   
-        print('checking for: {}'.format(key))
+    missing = {}
+    count = 0
+    for acq_list in acq_lists:
+        count += 1
+        key = scene_key.from_es_object(acq_list)
         if not key in ifgs and not key in blacklist:
-            missing.append(acq_lists[key])
-    return missing
+            missing[key.full_id_hash] = acq_list
+    print('Checked {} acq-lists.'.format(count))
+    return list(missing.values())
 
-def build_hashed_dict(object_list):
-    '''
-    Builds a dict of the object list where the keys are a hashed object of each objects
-    master and slave list. Returns the dict.
-    '''
-    hashed_dict = {}
-    for obj in object_list:
-        hashed_dict.update({gen_hash(obj):obj})
-    return hashed_dict
-
-def gen_hash(es_object):
-    '''Generates a hash from the master and slave scene list'''
-    met = es_object.get('_source', {}).get('metadata', {})
-    master = [get_starttime(x) for x in met.get('master_scenes', [])]
-    slave = [get_starttime(x) for x in met.get('slave_scenes', [])]
-    master = pickle.dumps(sorted(master))
-    slave = pickle.dumps(sorted(slave))
-    return '{}_{}'.format(hashlib.md5(master).hexdigest(), hashlib.md5(slave).hexdigest())
-
-def get_starttime(input_string):
-    '''returns the starttime from the input string. Used for comparison of acquisition ids to SLC ids'''
-    st_regex = '([1-2][0-9]{7}T[0-2][0-9][0-6][0-9][0-6][0-9])'
-    result = re.search(st_regex, input_string)
-    try:
-        starttime = result.group(0)
-        return starttime
-    except Exception, err:
-        raise Exception('input product: {} does not match regex:{}. Cannot compare SLCs to acquisition ids. {}'.format(input_string, st_regex, err))
-
-def get_ifgs():
-    '''
-    Returns all ifg products on ES
-    '''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/grq_*_s1-gunw/_search'.format(grq_ip)
-    es_query = {"query":{"bool":{"must":[{"match_all":{}}]}}, "from":0, "size":1000}
-    return query_es(grq_url, es_query)
-
-def get_acq_lists(acq_version):
-    '''Returns all acquisition-list products on ES matching the ifg_version'''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/grq_{1}_s1-gunw-acq-list/_search'.format(grq_ip, acq_version)
-    es_query = {"query":{"bool":{"must":[{"match_all":{}}]}}, "from":0, "size":1000}
-    return query_es(grq_url, es_query)
-
-def get_blacklist():
-    '''Returns all blacklist products'''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/grq_*_s1-gunw-ifg-blacklist/_search'.format(grq_ip)
-    es_query = {"query":{"bool":{"must":[{"match_all":{}}]}}, "from":0, "size":1000}
-    return query_es(grq_url, es_query)
-
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in es_query.keys():
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 1000
-        es_query['size'] = iterator_size
-    if 'from' in es_query.keys():
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    # run the query and iterate until all the results have been returned
-    print('querying: {}'.format(grq_url))
-    response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results['hits']['hits']
-    total_count = results['hits']['total']
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        results_list.extend(results['hits']['hits'])
-    return results_list
+def build_hash_set(object_list):
+    '''
+    Builds a scene_key.KeyIndex of the object list that only tracks membership, so the
+    objects themselves are not held.
+    '''
+    return scene_key.KeyIndex(object_list, keep_objects=False)
+
+def get_ifgs(since=None):
+    '''
+    Streams all ifg products on ES, or those created since the given timestamp
+    '''
+    grq_url = es_client.grq_url(IFG_IDX, '_search')
+    return es_client.scan(grq_url, build_scan_query(since))
+
+def get_acq_lists(acq_version, since=None):
+    '''Streams all acquisition-list products on ES matching the ifg_version, or those created since the given timestamp'''
+    grq_url = es_client.grq_url(ACQ_LIST_IDX.format(acq_version), '_search')
+    return es_client.scan(grq_url, build_scan_query(since))
+
+def get_blacklist(since=None):
+    '''Streams all blacklist products, or those created since the given timestamp'''
+    grq_url = es_client.grq_url(BLACKLIST_IDX, '_search')
+    return es_client.scan(grq_url, build_scan_query(since))
+
+def build_scan_query(since=None):
+    '''
+    Returns the scan query over the hash fields. If since is given, only products created
+    since then, less CHECKPOINT_OVERLAP to pick up late ingests, are matched.
+    '''
+    must = [{"match_all":{}}]
+    if since:
+        must = [{"range":{"creation_timestamp":{"gte":"{0}||-{1}".format(since, CHECKPOINT_OVERLAP)}}}]
+    return {"query":{"bool":{"must":must}}, "_source":scene_key.SOURCE_FIELDS + ['creation_timestamp']}
+
+def track_checkpoint(es_objects, checkpoints, name):
+    '''passes the es objects through, recording the latest creation_timestamp seen as checkpoints[name]'''
+    for obj in es_objects:
+        timestamp = obj.get('_source', {}).get('creation_timestamp')
+        if timestamp and timestamp > checkpoints.get(name, ''):
+            checkpoints[name] = timestamp
+        yield obj
+
+def find_existing_hashes(index, hashes):
+    '''
+    Returns the full_id_hashes that exist in the index (or comma separated indices), from the
+    worker-local hash index when it is enabled, otherwise from ES.
+    '''
+    local = hash_index.get_index()
+    if local is not None:
+        return local.find_existing(index, hashes)
+    return find_existing_hashes_on_es(index, hashes)
+
+def find_existing_hashes_on_es(index, hashes):
+    '''
+    Returns the full_id_hashes that exist in the index (or comma separated indices). Hashes
+    are sent in chunks of TERMS_CHUNK_SIZE as terms queries with size 0, so only the
+    matched hash buckets are returned.
+    '''
+    hashes = list(hashes)
+    grq_url = es_client.grq_url(index, '_search')
+    existing = set()
+    for i in range(0, len(hashes), TERMS_CHUNK_SIZE):
+        chunk = hashes[i:i + TERMS_CHUNK_SIZE]
+        es_query = {"query":{"terms":{"metadata.full_id_hash.raw":chunk}}, "size":0,
+                    "aggs":{"hashes":{"terms":{"field":"metadata.full_id_hash.raw", "size":len(chunk)}}}}
+        results = es_client.search(grq_url, es_query)
+        existing.update(bucket['key'] for bucket in results['aggregations']['hashes']['buckets'])
+    return existing
+
+def get_latest_timestamp(index):
+    '''returns the latest creation_timestamp on the index, or None if it is empty'''
+    grq_url = es_client.grq_url(index, '_search')
+    es_query = {"size":0, "aggs":{"latest":{"max":{"field":"creation_timestamp"}}}}
+    latest = es_client.search(grq_url, es_query).get('aggregations', {}).get('latest', {})
+    return latest.get('value_as_string')
+
+def load_state(state_file, acq_list_version):
+    '''loads the incremental state, returning None if there is none usable for the acq-list version'''
+    if not os.path.exists(state_file):
+        print('No incremental state found at {}.'.format(state_file))
+        return None
+    with open(state_file, 'r') as fin:
+        state = json.load(fin)
+    if state.get('acquisition_list_version') != acq_list_version:
+        print('Incremental state is for acquisition list version {}.'.format(state.get('acquisition_list_version')))
+        return None
+    return state
+
+def save_state(state_file, state):
+    '''atomically writes the incremental state'''
+    state_dir = os.path.dirname(state_file)
+    if state_dir and not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    tmp_file = '{}.tmp'.format(state_file)
+    with open(tmp_file, 'w') as fout:
+        json.dump(state, fout)
+    os.rename(tmp_file, state_file)
+
+def get_full_objects(es_objects, fields):
+    '''
+    Re-fetches the given (projected) es objects with the given _source fields, grouped
+    by index. Used to pull the full products only for the few that are built.
+    '''
+    by_index = {}
+    for obj in es_objects:
+        by_index.setdefault(obj['_index'], []).append(obj['_id'])
+    results = []
+    for index, ids in by_index.items():
+        grq_url = es_client.grq_url(index, '_search')
+        es_query = {"query":{"ids":{"values":ids}}, "_source":fields}
+        results.extend(es_client.query_es(grq_url, es_query))
+    return results
+
+def get_flag(ctx, name):
+    '''returns the boolean param of the context, which may be given as a "true" or "false" string'''
+    return str(ctx.get(name, False)).lower() == 'true'
 
 def load_context():
     '''loads the context file into a dict'''
@@ -173,4 +512,4 @@ def load_context():
         raise Exception('unable to parse _context.json from work directory')
 
 if __name__ == '__main__':
-    main()
+    metrics.run(main)
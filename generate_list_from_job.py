@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+'''
+From failed hysds jobs, decides in one pass whether the expected product of
+each job is blacklisted, greylisted or left alone, & builds the list products.
+'''
+
+from __future__ import print_function
+import json
+import fnmatch
+import es_client
+import scene_key
+import hash_index
+import list_product
+import metrics
+
+IFG_CFG_IDX = 'grq_*_s1-gunw-ifg-cfg'
+# list types in the order they are decided, the first whose threshold is met wins
+LIST_ORDER = ['blacklist', 'greylist']
+
+def main():
+    '''
+    Pulls the job info from context, and generates the blacklist or greylist product for
+    each job whose retry_count meets blacklist_at_retry_count or greylist_at_retry_count.
+    '''
+    print('Loading variables from context...')
+    ctx = load_context()
+    policy = {}
+    for list_type in LIST_ORDER:
+        threshold = ctx.get('{0}_at_retry_count'.format(list_type))
+        if threshold is not None and threshold != '':
+            policy[list_type] = int(threshold)
+    run_context(ctx, policy)
+
+def run_context(ctx, policy, processes=list_product.BUILD_PROCESSES):
+    '''
+    Runs the policy, a dict of list type to the retry_count at which it is generated, over
+    the job_contexts batch of the context, or the single job given by its fields. Raises if
+    any product failed to build, so the job is marked failed.
+    '''
+    hash_index.get_index(ctx.get('hash_index_db'))
+    job_contexts = ctx.get('job_contexts')
+    if not job_contexts:
+        job_contexts = [{'current_retry_count': ctx.get('current_retry_count', 0),
+                         'master_slcs': ctx.get('master_slcs', False), 'slave_slcs': ctx.get('slave_slcs', False)}]
+    results = run(job_contexts, policy, processes)
+    failed = [label for label, error in results if error]
+    if failed:
+        raise RuntimeError('Failed to build {} of {} products: {}'.format(len(failed), len(results), ', '.join(failed)))
+    return results
+
+def run(job_contexts, policy, processes=list_product.BUILD_PROCESSES):
+    '''
+    Generates list products for a batch of failed job contexts, each holding the
+    current_retry_count, master_slcs & slave_slcs of a job. Jobs are classified on retry
+    count before any lookups, then existing list products & ifg-cfgs are looked up for all
+    jobs at once. Returns the (label, error) build result of each product.
+    '''
+    retry_counts = {}
+    for job_ctx in job_contexts:
+        current_retry_count = job_ctx.get('current_retry_count', 0)
+        if isinstance(current_retry_count, list):
+            current_retry_count = current_retry_count[0] # if it's a list get the first item (will return list as lambda)
+        master_slcs = job_ctx.get('master_slcs', False)
+        slave_slcs = job_ctx.get('slave_slcs', False)
+        if not master_slcs or not slave_slcs:
+            print('master/slave metadata fields are not included in job met. Skipping.')
+            continue
+        hsh = scene_key.from_scenes(master_slcs, slave_slcs).direct_hash
+        retry_counts[hsh] = max(current_retry_count, retry_counts.get(hsh, 0))
+    candidates = dict((hsh, count) for hsh, count in retry_counts.items() if classify(count, set(), policy))
+    print('{} of {} jobs meet a list policy of {}.'.format(len(candidates), len(job_contexts), policy))
+    if not candidates:
+        return []
+    with metrics.phase('find_existing_lists'):
+        existing = find_existing_lists(list(candidates.keys()), policy)
+    decisions = {}
+    for hsh, count in candidates.items():
+        list_type = classify(count, existing.get(hsh, set()), policy)
+        if list_type is None:
+            print('list product already exists for full_id_hash : {}'.format(hsh))
+        else:
+            decisions[hsh] = list_type
+    with metrics.phase('get_ifg_cfgs'):
+        ifg_cfgs = get_ifg_cfgs(list(decisions.keys()))
+    results = []
+    for list_type in LIST_ORDER:
+        to_build = []
+        for hsh, decided in decisions.items():
+            if decided != list_type:
+                continue
+            if hsh not in ifg_cfgs:
+                print('Failed to get ifg_cfg with full_id_hash : {}'.format(hsh))
+                results.append((hsh, 'no ifg-cfg found'))
+                continue
+            to_build.append(ifg_cfgs[hsh])
+        if to_build:
+            print('building {} {} products'.format(len(to_build), list_type))
+            results.extend(list_product.build_many(to_build, list_type, processes))
+    return results
+
+def classify(retry_count, existing_types, policy):
+    '''
+    Returns the list type to build for a failed pair with the retry_count & the given list
+    types already built, or None. A blacklist supersedes a greylist, never the reverse.
+    '''
+    for list_type in LIST_ORDER:
+        if list_type in existing_types:
+            return None
+        if list_type in policy and retry_count >= policy[list_type]:
+            return list_type
+    return None
+
+def find_existing_lists(hashes, policy):
+    '''
+    Returns a dict of the given hashes with a list product to the set of their list types.
+    The hashes are looked up in the local hash index when it is enabled, otherwise on all
+    of the list indices of the policy together in one terms query.
+    '''
+    indices = dict((list_product.LIST_TYPES[list_type]['index'], list_type) for list_type in policy)
+    existing = {}
+    local = hash_index.get_index()
+    if local is not None:
+        for index, list_type in indices.items():
+            for hsh in local.find_existing(index, hashes):
+                existing.setdefault(hsh, set()).add(list_type)
+        return existing
+    query = {"query":{"filtered":{"filter":{"terms":{"metadata.full_id_hash.raw":hashes}}}},
+             "_source":["metadata.full_id_hash"], "size":len(hashes)}
+    results = es_client.query_es(es_client.grq_url(','.join(indices.keys()), '_search'), query)
+    for hit in results:
+        for index, list_type in indices.items():
+            if fnmatch.fnmatch(hit['_index'], index):
+                existing.setdefault(hit['_source']['metadata']['full_id_hash'], set()).add(list_type)
+    return existing
+
+def get_ifg_cfgs(hashes):
+    '''returns a dict of full_id_hash to the ifg-cfg for the given hashes, from one terms query'''
+    if not hashes:
+        return {}
+    grq_url = es_client.grq_url(IFG_CFG_IDX, '_search')
+    es_query = {"query":{"filtered":{"filter":{"terms":{"metadata.full_id_hash.raw":hashes}}}},
+                "_source":list_product.SOURCE_FIELDS, "size":len(hashes)}
+    ifg_cfgs = {}
+    for ifg_cfg in es_client.query_es(grq_url, es_query):
+        ifg_cfgs.setdefault(ifg_cfg['_source']['metadata']['full_id_hash'], ifg_cfg)
+    return ifg_cfgs
+
+def load_context():
+    '''loads the context file into a dict'''
+    try:
+        context_file = '_context.json'
+        with open(context_file, 'r') as fin:
+            context = json.load(fin)
+        return context
+    except:
+        raise Exception('unable to parse _context.json from work directory')
+
+if __name__ == '__main__':
+    metrics.run(main)
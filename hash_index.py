@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+'''
+Worker-local on-disk index of the full_id_hashes of the ifg, blacklist
+& greylist products on GRQ. Kept on the worker directory the job specs
+mount, so it is shared by the jobs on a node, & consulted in place of
+per-hash ES lookups. Each process tops it up with the products created
+since its checkpoint, & reloads an index whose product count no longer
+matches ES, eg after products were deleted.
+'''
+
+from __future__ import print_function
+import os
+import uuid
+import sqlite3
+import es_client
+import scene_key
+
+# an empty HASH_INDEX_DB, or no mount, disables it
+DB_PATH = os.environ.get('HASH_INDEX_DB', os.path.join(es_client.WORKER_DIR, 'hash_index.db') if os.path.isdir(es_client.WORKER_DIR) else None) or None
+LOCK_TIMEOUT = 60 # seconds to wait on another job's write lock
+CHECKPOINT_OVERLAP = '1h'
+SQL_CHUNK_SIZE = 500 # stays under the sqlite bound variable limit
+
+_INDEX = None
+
+class HashIndex(object):
+    '''
+    SQLite index of the (id, full_id_hash, creation_timestamp) of the products per index
+    pattern, with the latest creation_timestamp loaded per pattern. WAL journaling lets jobs
+    read while another job refreshes.
+    '''
+
+    def __init__(self, path):
+        db_dir = os.path.dirname(path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS products (idx TEXT, id TEXT, full_id_hash TEXT, '
+                              'creation_timestamp TEXT, generation TEXT, PRIMARY KEY (idx, id))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS products_hash ON products (idx, full_id_hash)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoints (idx TEXT PRIMARY KEY, creation_timestamp TEXT)')
+        self.refreshed = set()
+
+    def get_checkpoint(self, index):
+        '''returns the latest creation_timestamp loaded for the index, None if never loaded'''
+        row = self.conn.execute('SELECT creation_timestamp FROM checkpoints WHERE idx = ?', (index,)).fetchone()
+        return row[0] if row else None
+
+    def lookup(self, index, hashes):
+        '''returns the set of the given hashes that the index holds'''
+        hashes = list(hashes)
+        found = set()
+        for i in range(0, len(hashes), SQL_CHUNK_SIZE):
+            chunk = hashes[i:i + SQL_CHUNK_SIZE]
+            sql = 'SELECT full_id_hash FROM products WHERE idx = ? AND full_id_hash IN ({0})'.format(','.join('?' * len(chunk)))
+            found.update(row[0] for row in self.conn.execute(sql, [index] + chunk))
+        return found
+
+    def find_existing(self, index, hashes):
+        '''returns the set of the given hashes that exist on the index, or any of the comma separated indices'''
+        hashes = list(hashes)
+        existing = set()
+        for pattern in index.split(','):
+            self.refresh(pattern)
+            existing.update(self.lookup(pattern, hashes))
+        return existing
+
+    def refresh(self, index):
+        '''
+        Loads the products of the index created since its checkpoint, less CHECKPOINT_OVERLAP
+        for late ingests, or all of them on first use. The index is then reloaded if the
+        products it holds up to the checkpoint do not match the count on ES. Runs at most
+        once per index per process.
+        '''
+        if index in self.refreshed:
+            return
+        since = self.get_checkpoint(index)
+        if since is None:
+            self.load(index)
+        else:
+            self.load(index, since)
+            latest = self.get_checkpoint(index)
+            local, remote = self.count(index, latest), count_on_es(index, latest)
+            if local != remote:
+                print('local hash index holds {} products of {} up to {}, {} on ES. Reloading.'.format(local, index, latest, remote))
+                self.load(index)
+        self.refreshed.add(index)
+
+    def load(self, index, since=None):
+        '''
+        Loads the products of the index created since the given timestamp, or all of them,
+        advancing its checkpoint. A full load removes the products no longer on ES once
+        done, so readers keep the previous products meanwhile.
+        '''
+        generation = uuid.uuid4().hex
+        latest = since or ''
+        count = 0
+        batch = []
+        for hit in es_client.scan(es_client.grq_url(index, '_search'), build_scan_query(since)):
+            timestamp = hit.get('_source', {}).get('creation_timestamp')
+            batch.append((index, hit['_id'], scene_key.from_es_object(hit).full_id_hash, timestamp, generation))
+            latest = max(latest, timestamp or '')
+            if len(batch) >= es_client.PAGE_SIZE:
+                self._insert(batch)
+                count += len(batch)
+                batch = []
+        self._insert(batch)
+        count += len(batch)
+        with self.conn:
+            if since is None:
+                self.conn.execute('DELETE FROM products WHERE idx = ? AND generation != ?', (index, generation))
+            self.conn.execute('INSERT OR REPLACE INTO checkpoints (idx, creation_timestamp) VALUES (?, ?)', (index, latest or None))
+        print('loaded {} products from {} into the local hash index.'.format(count, index))
+
+    def _insert(self, rows):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO products (idx, id, full_id_hash, creation_timestamp, generation) '
+                                  'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def count(self, index, until=None):
+        '''returns the number of products of the index held, created until the timestamp or undated'''
+        sql = 'SELECT COUNT(*) FROM products WHERE idx = ?'
+        args = [index]
+        if until:
+            sql += ' AND (creation_timestamp IS NULL OR creation_timestamp <= ?)'
+            args.append(until)
+        return self.conn.execute(sql, args).fetchone()[0]
+
+def build_scan_query(since=None):
+    '''returns the scan query over the hash fields of the products created since the timestamp, or all'''
+    must = [{"match_all":{}}]
+    if since:
+        must = [{"range":{"creation_timestamp":{"gte":"{0}||-{1}".format(since, CHECKPOINT_OVERLAP)}}}]
+    return {"query":{"bool":{"must":must}}, "_source":scene_key.SOURCE_FIELDS + ['creation_timestamp']}
+
+def count_on_es(index, until=None):
+    '''returns the number of products on the index created until the timestamp or undated'''
+    es_query = {"size":0}
+    if until:
+        es_query["query"] = {"bool":{"should":[{"range":{"creation_timestamp":{"lte":until}}},
+                                               {"bool":{"must_not":[{"exists":{"field":"creation_timestamp"}}]}}]}}
+    return es_client.search(es_client.grq_url(index, '_search'), es_query).get('hits', {}).get('total', 0)
+
+def get_index(path=None):
+    '''
+    Returns the shared HashIndex, opening it at path, by default DB_PATH, on first use. Returns
+    None if no path is set or the index can not be opened.
+    '''
+    global _INDEX
+    path = path or DB_PATH
+    if _INDEX is None and path:
+        try:
+            _INDEX = HashIndex(path)
+        except (sqlite3.Error, OSError) as err:
+            print('local hash index unavailable at {}: {}'.format(path, err))
+            return None
+    return _INDEX
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+'''
+Builds s1-ifg-blacklist & s1-ifg-greylist products from ifg-cfg products.
+The list types differ only in the settings held in LIST_TYPES.
+'''
+
+from __future__ import print_function
+import os
+import json
+import shutil
+from multiprocessing import Pool
+import dateutil.parser
+from hysds.celery import app
+from hysds.dataset_ingest import ingest
+import scene_key
+import metrics
+
+VERSION = 'v1.0'
+LIST_TYPES = {
+    'blacklist': {'prefix': 'S1-GUNW-BLACKLIST', 'index': 'grq_*_s1-gunw-blacklist', 'orbit_number': False},
+    'greylist': {'prefix': 'S1-GUNW-GREYLIST', 'index': 'grq_*_s1-gunw-greylist', 'orbit_number': True},
+}
+# _source fields read when building a product, for projecting ifg-cfg/acq-list queries
+SOURCE_FIELDS = ['starttime', 'endtime', 'metadata.starttime', 'metadata.endtime', 'metadata.union_geojson',
+                 'metadata.master_scenes', 'metadata.slave_scenes', 'metadata.reference_scenes',
+                 'metadata.secondary_scenes', 'metadata.track_number', 'metadata.track', 'metadata.orbitNumber',
+                 'metadata.master_orbit_file', 'metadata.slave_orbit_file', 'metadata.full_id_hash']
+DATASETS_CFG = './datasets.json'
+BUILD_PROCESSES = 4
+
+
+def build(ifg_cfg, list_type):
+    '''Builds and submits a list product of the list type from an ifg_cfg.'''
+    ds = build_dataset(ifg_cfg, list_type)
+    met = build_met(ifg_cfg, list_type)
+    build_product_dir(ds, met)
+    submit_product(ds)
+    print('Publishing Product: {0}'.format(ds['label']))
+    print('    version:        {0}'.format(ds['version']))
+    print('    starttime:      {0}'.format(ds['starttime']))
+    print('    endtime:        {0}'.format(ds['endtime']))
+    print('    location:       {0}'.format(ds['location']))
+    return ds['label']
+
+def build_many(ifg_cfgs, list_type, processes=BUILD_PROCESSES):
+    '''
+    Builds and submits a product from each ifg_cfg across a pool of processes, checking the
+    dataset config once up front if there is any to build. Returns a (label, error) tuple per
+    product, where error is None if the product was submitted.
+    '''
+    unique = {}
+    for ifg_cfg in ifg_cfgs:
+        unique.setdefault(build_id(ifg_cfg, list_type), ifg_cfg)
+    tasks = [(ifg_cfg, list_type) for ifg_cfg in unique.values()]
+    if not tasks:
+        return []
+    load_datasets_config()
+    with metrics.phase('build_products'):
+        if processes > 1 and len(tasks) > 1:
+            pool = Pool(min(processes, len(tasks)))
+            try:
+                results = pool.map(build_safe, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [build_safe(task) for task in tasks]
+    for label, error in results:
+        if error:
+            print('failed to build {0}: {1}'.format(label, error))
+    print('Submitted {0} of {1} products.'.format(len([x for x in results if x[1] is None]), len(results)))
+    return results
+
+def build_safe(task):
+    '''builds the product from the (ifg_cfg, list_type) task, returning its (label, error) instead of raising'''
+    ifg_cfg, list_type = task
+    label = ifg_cfg.get('_id')
+    try:
+        label = build_id(ifg_cfg, list_type)
+        build(ifg_cfg, list_type)
+        return label, None
+    except Exception as err:
+        return label, '{0}: {1}'.format(type(err).__name__, err)
+
+def load_datasets_config(path=DATASETS_CFG):
+    '''parses the dataset config, raising if it is missing or invalid'''
+    try:
+        with open(path, 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError) as err:
+        raise Exception('unable to parse dataset config {0}: {1}'.format(path, err))
+
+def build_id(ifg, list_type):
+    hsh = gen_hash(ifg)
+    master_date = get_master_date(ifg)
+    slave_date = get_slave_date(ifg)
+    uid = '{}-{}_{}-{}-{}'.format(LIST_TYPES[list_type]['prefix'], master_date, slave_date, hsh, VERSION)
+    return uid
+
+def get_hash(es_obj):
+    '''retrieves the full_id_hash. if it doesn't exists, it
+        attempts to generate one'''
+    return scene_key.from_es_object(es_obj).full_id_hash
+
+def gen_hash(es_obj):
+    '''copy of hash used in the enumerator'''
+    return scene_key.from_es_object(es_obj).direct_hash
+
+def get_master_date(ifg_cfg):
+    '''returns the master date'''
+    return dateutil.parser.parse(ifg_cfg.get('_source').get('endtime')).strftime('%Y%m%d')
+
+def get_slave_date(ifg_cfg):
+    '''returns the master date'''
+    return dateutil.parser.parse(ifg_cfg.get('_source').get('starttime')).strftime('%Y%m%d')
+
+def build_dataset(ifg_cfg, list_type):
+    '''Generates the ds dict for the list product from an ifg-cfg'''
+    uid = build_id(ifg_cfg, list_type)
+    starttime = ifg_cfg['_source']['metadata']['starttime']
+    endtime = ifg_cfg['_source']['metadata']['endtime']
+    location = ifg_cfg['_source']['metadata']['union_geojson']
+    ds = {'label':uid, 'starttime':starttime, 'endtime':endtime, 'location':location, 'version':VERSION}
+    return ds
+
+def build_met(ifg_cfg, list_type):
+    '''Generates the met dict for the list product from an ifg-cfg'''
+    met = ifg_cfg.get('_source', {}).get('metadata', {})
+    master_scenes = met.get('master_scenes', met.get('reference_scenes', False))
+    slave_scenes = met.get('slave_scenes', met.get('secondary_scenes', False))
+    track = ifg_cfg['_source']['metadata'].get('track_number', False)
+    if track is False:
+        track = ifg_cfg['_source']['metadata'].get('track', False)
+    master_orbit_file = ifg_cfg['_source']['metadata'].get('master_orbit_file', False)
+    slave_orbit_file = ifg_cfg['_source']['metadata'].get('slave_orbit_file', False)
+    hsh = get_hash(ifg_cfg)
+    met = {'reference_scenes': master_scenes, 'secondary_scenes': slave_scenes,
+           'master_orbit_file': master_orbit_file, 'slave_orbit_file': slave_orbit_file, 'track_number': track,
+    'full_id_hash': hsh}
+    if LIST_TYPES[list_type]['orbit_number']:
+        met['orbit_number'] = ifg_cfg['_source']['metadata'].get('orbitNumber', False)
+    return met
+
+def build_product_dir(ds, met):
+    '''generates the product'''
+    label = ds['label']
+    ds_dir = os.path.join(os.getcwd(), label)
+    ds_path = os.path.join(ds_dir, '{0}.dataset.json'.format(label))
+    met_path = os.path.join(ds_dir, '{0}.met.json'.format(label))
+    if not os.path.exists(ds_dir):
+        os.mkdir(ds_dir)
+    with open(ds_path, 'w') as outfile:
+        json.dump(ds, outfile)
+    with open(met_path, 'w') as outfile:
+        json.dump(met, outfile)
+
+def submit_product(ds):
+    uid = ds['label']
+    ds_dir = os.path.join(os.getcwd(), uid)
+    try:
+        ingest(uid, DATASETS_CFG, app.conf.GRQ_UPDATE_URL, app.conf.DATASET_PROCESSED_QUEUE, ds_dir, None)
+    except Exception:
+        print('failed on submission of {0}'.format(uid))
+        raise
+    if os.path.exists(uid):
+        shutil.rmtree(uid)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+'''
+Per-phase wall time & ES I/O counters for a job run, written to
+metrics.json in the work directory so HySDS keeps them with the job.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import profiler
+
+METRICS_FILE = 'metrics.json'
+COUNTERS = ('requests', 'pages', 'hits', 'bytes_sent', 'bytes_received', 'request_time')
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_PHASES = OrderedDict()
+_INDICES = OrderedDict()
+_TOTAL = dict((counter, 0) for counter in COUNTERS)
+
+def _new_entry():
+    '''returns a zeroed counter entry'''
+    entry = OrderedDict([('calls', 0), ('wall_time', 0.0)])
+    entry.update((counter, 0) for counter in COUNTERS)
+    return entry
+
+def _stack():
+    '''returns the stack of phases open on the current thread'''
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+@contextmanager
+def phase(name):
+    '''
+    Times the enclosed block as the named phase. ES I/O made on the same thread while it is
+    open, or by functions it runs on pool threads through inherit_phases, is counted against
+    it & against every phase enclosing it. Build processes keep their own counters.
+    '''
+    stack = _stack()
+    stack.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        stack.pop()
+        with _LOCK:
+            entry = _PHASES.setdefault(name, _new_entry())
+            entry['calls'] += 1
+            entry['wall_time'] += elapsed
+
+def inherit_phases(func):
+    '''
+    Wraps func to run with the phases open on the calling thread, so ES I/O it makes on a
+    pool thread is counted against them. Phases it opens itself are timed as usual.
+    '''
+    parent = list(_stack())
+    def wrapper(*args, **kwargs):
+        saved = _stack()
+        _LOCAL.stack = list(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _LOCAL.stack = saved
+    return wrapper
+
+def record(index=None, **counts):
+    '''adds the I/O counts to the open phases of the current thread, the index & the job total'''
+    names = set(_stack())
+    with _LOCK:
+        entries = [_TOTAL] + [_PHASES.setdefault(name, _new_entry()) for name in names]
+        if index:
+            entries.append(_INDICES.setdefault(index, _new_entry()))
+        for entry in entries:
+            for counter, value in counts.items():
+                entry[counter] += value
+
+def summary():
+    '''returns the metrics recorded so far'''
+    with _LOCK:
+        return OrderedDict([('total', dict(_TOTAL)), ('phases', json.loads(json.dumps(_PHASES))),
+                            ('indices', json.loads(json.dumps(_INDICES)))])
+
+def write(path=METRICS_FILE):
+    '''
+    Writes the metrics under the name of the running script, keeping those of other
+    scripts run in the same work directory, e.g. by validate.sh. Failures are ignored.
+    '''
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'job'
+    try:
+        runs = OrderedDict()
+        if os.path.exists(path):
+            with open(path, 'r') as fin:
+                runs = json.load(fin, object_pairs_hook=OrderedDict)
+        runs[script] = summary()
+        with open(path, 'w') as fout:
+            json.dump(runs, fout, indent=2)
+    except (IOError, OSError, ValueError) as err:
+        print('failed to write metrics: {}'.format(err))
+
+def run(func, *args, **kwargs):
+    '''
+    Runs the job's main function as the job phase, under the profiler if it is enabled,
+    writing the metrics file when it exits.
+    '''
+    try:
+        with phase('job'):
+            with profiler.profile():
+                return func(*args, **kwargs)
+    finally:
+        write()
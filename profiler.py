@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+'''
+Opt-in profiling of a job's main function. Set profile in the job context, or
+SPV_PROFILE in the environment, to sample or cprofile. The profile & a top-N
+summary are written to the work directory under the name of the running script,
+e.g. generate_blacklist.profile.txt, so HySDS keeps them with the job.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+MODES = ('sample', 'cprofile')
+SAMPLE_INTERVAL = 0.01 # seconds between stack samples
+MAX_OVERHEAD = 0.02 # max fraction of wall time the sampler may spend taking samples
+TOP_N = 30
+SAMPLE_FILE = 'profile.folded' # collapsed stacks, as read by flamegraph.pl & speedscope
+CPROFILE_FILE = 'profile.prof' # pstats dump
+SUMMARY_FILE = 'profile.txt'
+
+def get_settings(ctx=None):
+    '''
+    Returns the (mode, rate, max_overhead) profiling settings from the context, where the
+    SPV_PROFILE, SPV_PROFILE_RATE & SPV_PROFILE_MAX_OVERHEAD environment variables win.
+    rate is the fraction of jobs profiled. cprofile has no overhead cap, so is refused for a
+    rate under 1, where it would be left on across jobs.
+    '''
+    if ctx is None:
+        ctx = load_context()
+    mode = os.environ.get('SPV_PROFILE', ctx.get('profile')) or None
+    rate = float(os.environ.get('SPV_PROFILE_RATE', ctx.get('profile_rate')) or 1.0)
+    max_overhead = float(os.environ.get('SPV_PROFILE_MAX_OVERHEAD', ctx.get('profile_max_overhead')) or MAX_OVERHEAD)
+    if mode not in MODES:
+        if mode not in (None, 'none', 'off'):
+            print('Unknown profile mode {}, expected one of {}. Not profiling.'.format(mode, ', '.join(MODES)))
+        mode = None
+    elif mode == 'cprofile' and rate < 1:
+        print('cprofile has no overhead cap, so is not run at a profile rate under 1 ({}). Not profiling.'.format(rate))
+        mode = None
+    return mode, rate, max_overhead
+
+@contextmanager
+def profile(ctx=None):
+    '''
+    Profiles the enclosed block if enabled & the job is picked at the profile rate. The
+    sampler is held under the overhead cap. cprofile traces every call of the main thread
+    & is uncapped, so is only run for one-off profiles at a rate of 1.
+    '''
+    mode, rate, max_overhead = get_settings(ctx)
+    if mode is None or random.random() >= rate:
+        yield
+        return
+    print('Profiling with {}, summary in {}.'.format(mode, output_path(SUMMARY_FILE)))
+    start = time.time()
+    if mode == 'cprofile':
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            write_cprofile(prof, time.time() - start)
+        return
+    sampler = Sampler(SAMPLE_INTERVAL, max_overhead)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        write_samples(sampler, time.time() - start)
+
+class Sampler(object):
+    '''
+    Samples the stacks of all other threads from a daemon thread. The wait after each
+    sample grows with its cost, so sampling never takes more than max_overhead of wall time.
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL, max_overhead=MAX_OVERHEAD):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = Counter()
+        self.samples = 0
+        self.sample_time = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.sample()
+            cost = time.time() - start
+            self.samples += 1
+            self.sample_time += cost
+            self._stop.wait(max(self.interval, cost / self.max_overhead - cost))
+
+    def sample(self):
+        '''adds the current stack of each thread, outermost frame first'''
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{0}'.format(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+
+def output_path(name):
+    '''returns the file name prefixed with the running script's name, as metrics.write keys its runs'''
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'job'
+    return '{0}.{1}'.format(script, name)
+
+def write_samples(sampler, wall_time, folded_path=None, summary_path=None):
+    '''writes the collapsed stacks & the functions with the most own & total samples'''
+    folded_path = folded_path or output_path(SAMPLE_FILE)
+    summary_path = summary_path or output_path(SUMMARY_FILE)
+    own = Counter()
+    total = Counter()
+    for stack, count in sampler.stacks.items():
+        own[stack[-1]] += count
+        for func in set(stack[1:]):
+            total[func] += count
+    try:
+        with open(folded_path, 'w') as fout:
+            for stack, count in sampler.stacks.most_common():
+                fout.write('{0} {1}\n'.format(';'.join(stack), count))
+        with open(summary_path, 'w') as fout:
+            fout.write('mode: sample\nwall time: {0:.2f}s\nsamples: {1}\nsampling time: {2:.3f}s ({3:.2%} of wall time, cap {4:.2%})\n'.format(
+                wall_time, sampler.samples, sampler.sample_time, sampler.sample_time / wall_time if wall_time else 0, sampler.max_overhead))
+            for title, counts in (('own', own), ('total', total)):
+                fout.write('\ntop {0} by {1} samples:\n'.format(TOP_N, title))
+                for func, count in counts.most_common(TOP_N):
+                    fout.write('{0:8d} {1}\n'.format(count, func))
+    except (IOError, OSError) as err:
+        print('failed to write profile: {}'.format(err))
+
+def write_cprofile(prof, wall_time, prof_path=None, summary_path=None):
+    '''writes the pstats dump & the functions with the most cumulative & own time'''
+    prof_path = prof_path or output_path(CPROFILE_FILE)
+    summary_path = summary_path or output_path(SUMMARY_FILE)
+    try:
+        prof.dump_stats(prof_path)
+        with open(summary_path, 'w') as fout:
+            fout.write('mode: cprofile\nwall time: {0:.2f}s\n'.format(wall_time))
+            stats = pstats.Stats(prof, stream=fout)
+            for sort in ('cumulative', 'tottime'):
+                fout.write('\ntop {0} by {1}:\n'.format(TOP_N, sort))
+                stats.sort_stats(sort).print_stats(TOP_N)
+    except (IOError, OSError) as err:
+        print('failed to write profile: {}'.format(err))
+
+def load_context():
+    '''loads the context file into a dict, or an empty dict outside of a job'''
+    try:
+        with open('_context.json', 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
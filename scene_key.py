@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+'''
+Canonical master/slave scene keys for matching acq-lists, ifg-cfgs, ifgs
+& blacklist/greylist products. Every module hashes products through here.
+'''
+
+import re
+import json
+import pickle
+import hashlib
+
+STARTTIME_REGEX = '([1-2][0-9]{7}T[0-2][0-9][0-6][0-9][0-6][0-9])'
+CACHE_SIZE = 2 ** 18 # max memoized scene pairs per hash form
+# _source fields needed to build the scene key of a product
+SOURCE_FIELDS = ['metadata.master_scenes', 'metadata.slave_scenes', 'metadata.reference_scenes',
+                 'metadata.secondary_scenes', 'metadata.full_id_hash']
+
+_STARTTIME_RE = re.compile(STARTTIME_REGEX)
+
+def memoize(func):
+    '''memoizes a function of hashable args, dropping the cache when it reaches CACHE_SIZE'''
+    cache = {}
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            if len(cache) >= CACHE_SIZE:
+                cache.clear()
+            result = cache[args] = func(*args)
+            return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.cache = cache
+    return wrapper
+
+class SceneKey(object):
+    '''
+    Immutable key of a product's master & slave scene ids. Exposes the enumerator hash
+    (full_id_hash/direct_hash) and the scene starttime hash (pair_hash), which matches
+    acquisition ids to SLC ids. A stored full_id_hash is trusted as given.
+    '''
+    __slots__ = ('master', 'slave', 'stored_hash')
+
+    def __init__(self, master, slave, stored_hash=None):
+        object.__setattr__(self, 'master', master)
+        object.__setattr__(self, 'slave', slave)
+        object.__setattr__(self, 'stored_hash', stored_hash or None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SceneKey is immutable')
+
+    @property
+    def direct_hash(self):
+        '''the enumerator hash generated from the scene ids'''
+        return direct_hash(self.master, self.slave)
+
+    @property
+    def full_id_hash(self):
+        '''the stored full_id_hash, or the enumerator hash if none was stored'''
+        return self.stored_hash or direct_hash(self.master, self.slave)
+
+    @property
+    def pair_hash(self):
+        '''the hash of the master & slave scene starttimes'''
+        return pair_hash(self.master, self.slave)
+
+    def matches(self, other):
+        '''returns True if both keys store the same full_id_hash, or share the scene starttimes'''
+        if self.stored_hash and self.stored_hash == other.stored_hash:
+            return True
+        return self.pair_hash == other.pair_hash
+
+    def __repr__(self):
+        return 'SceneKey({0!r}, {1!r}, {2!r})'.format(self.master, self.slave, self.stored_hash)
+
+def from_es_object(es_object):
+    '''returns the SceneKey of the es object'''
+    met = es_object.get('_source', {}).get('metadata', {})
+    master = met.get('master_scenes', met.get('reference_scenes')) or []
+    slave = met.get('slave_scenes', met.get('secondary_scenes')) or []
+    return SceneKey(scene_ids(master), scene_ids(slave), met.get('full_id_hash'))
+
+def from_scenes(master_scenes, slave_scenes):
+    '''returns the SceneKey of the given master & slave scene lists'''
+    return SceneKey(scene_ids(master_scenes), scene_ids(slave_scenes))
+
+def scene_ids(scenes):
+    '''returns the sorted tuple of scene ids. Scenes given as (id, ...) lists use their first item'''
+    return tuple(scene[0] if isinstance(scene, (tuple, list)) else scene for scene in sorted(scenes))
+
+@memoize
+def direct_hash(master_ids, slave_ids):
+    '''generates the enumerator hash directly from sorted scene id tuples'''
+    return hashlib.md5(json.dumps([' '.join(master_ids), ' '.join(slave_ids)]).encode('utf8')).hexdigest()
+
+@memoize
+def pair_hash(master_ids, slave_ids):
+    '''generates a hash from the master and slave scene starttimes'''
+    master = pickle.dumps(sorted([get_starttime(x) for x in master_ids]))
+    slave = pickle.dumps(sorted([get_starttime(x) for x in slave_ids]))
+    return '{}_{}'.format(hashlib.md5(master).hexdigest(), hashlib.md5(slave).hexdigest())
+
+def get_starttime(input_string):
+    '''returns the starttime from the input string. Used for comparison of acquisition ids to SLC ids'''
+    result = _STARTTIME_RE.search(input_string)
+    if result is None:
+        raise Exception('input product: {} does not match regex:{}. Cannot compare SLCs to acquisition ids.'.format(input_string, STARTTIME_REGEX))
+    return result.group(0)
+
+class KeyIndex(object):
+    '''
+    Index of es objects by SceneKey. Lookups match on a stored full_id_hash first, and
+    fall back to the pair_hash, which is only computed once a lookup misses. Its length
+    is the number of distinct pair_hashes.
+    '''
+    __slots__ = ('_by_full', '_by_pair', '_pending')
+
+    def __init__(self, es_objects=(), keep_objects=True):
+        self._by_full = {}
+        self._by_pair = {}
+        self._pending = []
+        for es_object in es_objects:
+            self.add(from_es_object(es_object), es_object if keep_objects else True)
+
+    def add(self, key, value=True):
+        '''adds the value under the given SceneKey'''
+        if key.stored_hash:
+            self._by_full[key.stored_hash] = value
+        self._pending.append((key, value))
+
+    def get(self, key, default=None):
+        '''returns the value stored under a key matching the given SceneKey'''
+        if key.stored_hash and key.stored_hash in self._by_full:
+            return self._by_full[key.stored_hash]
+        self._index_pending()
+        return self._by_pair.get(key.pair_hash, default)
+
+    def _index_pending(self):
+        '''indexes the keys added since the last lookup by pair_hash'''
+        if self._pending:
+            for pending_key, value in self._pending:
+                self._by_pair[pending_key.pair_hash] = value
+            self._pending = []
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        self._index_pending()
+        return len(self._by_pair)
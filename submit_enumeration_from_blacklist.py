@@ -7,113 +7,112 @@ for all AOIs and POEORBS covered by the product.
 
 from __future__ import print_function
 import json
-import requests
-from hysds.celery import app
+import es_client
 import submit_job
+import metrics
 
 ALLOWED_PROD_TYPES = ['S1-GUNW-BLACKLIST']
 AUDIT_TRAIL_IDX = 'grq_*_s1-gunw-acqlist-audit_trail'
 POEORB_IDX = 'grq_*_s1-aux_poeorb'
+MANIFEST = 'submitted_jobs.json'
 
 def main():
     '''main loop'''
     #stage inputs
     ctx = load_context()
-    #dataset inputs
-    prod_type = ctx.get('prod_type', False)
-    poeorb_id = ctx.get('master_orbit_file', False)
-    full_id_hash = ctx.get('full_id_hash', False)
+    #dataset inputs, a blacklist_products batch or a single product
+    products = ctx.get('blacklist_products') or [{'prod_type': ctx.get('prod_type', False),
+                                                  'master_orbit_file': ctx.get('master_orbit_file', False),
+                                                  'full_id_hash': ctx.get('full_id_hash', False)}]
     # user inputs
     skip_days = ctx.get('skipDays', 0)
     minmatch = ctx.get('minMatch', 2)
     queue = ctx.get('enumerator_queue', 'standard_product-s1gunw-acq_enumerator')
     version = ctx.get('enumeration_job_version', 'master')
     acquisition_version = ctx.get('acquisition_version')
-    if not prod_type in ALLOWED_PROD_TYPES:
-        raise Exception('Product type of {} not allowed as input.'.format(prod_type))
-    #determine covered aois
-    aois = get_aois(full_id_hash)
-    print('found {} aoi(s) covering blacklist: {}'.format(len(aois), ', '.join(aois)))
-    #get track
-    track = get_track(full_id_hash)
-    #get poeorb object
-    poeorb = get_poeorb(poeorb_id)
-    #submit enumeration job per aoi
-    for aoi in aois:
-        print('submitting enumeration job for poeorb id: {}, over aoi: {}, with track: {}'.format(poeorb_id, aoi, track))
-        submit_enum_job(poeorb, aoi, track, queue, version, minmatch, acquisition_version, skip_days, False)
+    jobs, errors = build_enum_jobs(products, queue, version, minmatch, acquisition_version, skip_days)
+    results = submit_job.submit_many(jobs, manifest=MANIFEST) if jobs else []
+    es_client.log_cache_stats()
+    failed = [x for x in results if 'error' in x]
+    if failed:
+        errors.append('failed to submit {} of {} enumeration jobs. See {}'.format(len(failed), len(results), MANIFEST))
+    if errors:
+        raise Exception('\n'.join(errors))
 
-def get_aois(full_id_hash):
-    '''determines all aois covered by the given hash'''
-    aois = []
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, AUDIT_TRAIL_IDX)
-    must = [{"term": {"metadata.full_id_hash.raw": full_id_hash}}]
-    grq_query = {"query": {"filtered": {'filter': {"bool": {"must": must}}}}, "from": 0, "size": 20}
-    audit_trails = query_es(grq_url, grq_query)
-    for audit in audit_trails:
-        aoi = audit.get('_source', {}).get('metadata', {}).get('aoi', False)
+def build_enum_jobs(products, queue, version, minmatch, acquisition_version, skip_days):
+    '''
+    Returns the unique (poeorb, aoi, track) enumeration jobs covering the blacklist products, a
+    list of dicts of their prod_type, master_orbit_file & full_id_hash, along with the errors of the
+    products skipped. Audit trails & poeorbs are fetched once for all of the products.
+    '''
+    errors = []
+    valid = []
+    for product in products:
+        if product.get('prod_type') in ALLOWED_PROD_TYPES:
+            valid.append(product)
+        else:
+            errors.append('Product type of {} not allowed as input.'.format(product.get('prod_type')))
+    with metrics.phase('get_audit_info'):
+        audit_info = get_audit_info(set(x['full_id_hash'] for x in valid))
+    with metrics.phase('get_poeorbs'):
+        poeorbs = get_poeorbs(set(x['master_orbit_file'] for x in valid))
+    jobs = {}
+    for product in valid:
+        full_id_hash = product['full_id_hash']
+        poeorb_id = product['master_orbit_file']
+        aois, track = audit_info.get(full_id_hash, ([], False))
+        print('found {} aoi(s) covering blacklist: {}'.format(len(aois), ', '.join(aois)))
+        if not track:
+            errors.append('no audit trail product found for {}. Unable to determine appropriate track.'.format(full_id_hash))
+            continue
+        if poeorb_id not in poeorbs:
+            errors.append('no audit poeorbn product found for {}. Unable to submit enumeration job.'.format(poeorb_id))
+            continue
+        for aoi in aois:
+            if (poeorb_id, aoi, track) in jobs:
+                continue
+            print('submitting enumeration job for poeorb id: {}, over aoi: {}, with track: {}'.format(poeorb_id, aoi, track))
+            jobs[(poeorb_id, aoi, track)] = build_enum_job(poeorbs[poeorb_id], aoi, track, queue, version, minmatch, acquisition_version, skip_days, False)
+    print('collapsed {} blacklist product(s) into {} enumeration job(s)'.format(len(products), len(jobs)))
+    return list(jobs.values()), errors
+
+def get_audit_info(full_id_hashes):
+    '''returns a dict of each hash to the (aois, track) covered by its audit trails, from one query'''
+    if not full_id_hashes:
+        return {}
+    grq_url = es_client.grq_url(AUDIT_TRAIL_IDX, '_search')
+    must = [{"terms": {"metadata.full_id_hash.raw": list(full_id_hashes)}}]
+    grq_query = {"query": {"filtered": {'filter': {"bool": {"must": must}}}}, "_source": ["metadata.aoi", "metadata.track_number", "metadata.full_id_hash"]}
+    audit_info = {}
+    for audit in es_client.query_es(grq_url, grq_query):
+        met = audit.get('_source', {}).get('metadata', {})
+        aois, track = audit_info.setdefault(met.get('full_id_hash'), ([], False))
+        aoi = met.get('aoi', False)
         if aoi and aoi not in aois:
             aois.append(aoi)
-    return aois
-
-def get_track(full_id_hash):
-    '''determines the track covered by the given hash'''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, AUDIT_TRAIL_IDX)
-    must = [{"term": {"metadata.full_id_hash.raw": full_id_hash}}]
-    grq_query = {"query": {"filtered": {'filter': {"bool": {"must": must}}}}, "from": 0, "size": 20}
-    audit_trails = query_es(grq_url, grq_query)
-    for audit in audit_trails:
-        track = audit.get('_source', {}).get('metadata', {}).get('track_number', False)
-        if track:
-            return track
-    raise Exception('no audit trail product found. Unable to determine appropriate track.')
+        if not track and met.get('track_number', False):
+            audit_info[met.get('full_id_hash')] = (aois, met['track_number'])
+    return audit_info
 
-def get_poeorb(poeorb_id):
-    '''returns the poeorb es object'''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, POEORB_IDX)
-    must = [{"term": {"metadata.archive_filename.raw": poeorb_id}}]
-    grq_query = {"query": {"filtered": {'filter': {"bool": {"must": must}}}}, "from": 0, "size": 20}
-    poeorbs = query_es(grq_url, grq_query)
-    if not poeorbs:
-        raise Exception('no audit poeorbn product found. Unable to submit enumeration job.')
-    return poeorbs[0]
-
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in es_query.keys():
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10
-        es_query['size'] = iterator_size
-    if 'from' in es_query.keys():
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    #run the query and iterate until all the results have been returned
-    #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
+def get_poeorbs(poeorb_ids):
+    '''returns a dict of each poeorb id to its es object, from one query'''
+    if not poeorb_ids:
+        return {}
+    grq_url = es_client.grq_url(POEORB_IDX, '_search')
+    must = [{"terms": {"metadata.archive_filename.raw": list(poeorb_ids)}}]
+    grq_query = {"query": {"filtered": {'filter': {"bool": {"must": must}}}}, "_source": ["starttime", "endtime", "metadata.platform", "metadata.archive_filename", "urls"]}
+    poeorbs = {}
+    for poeorb in es_client.query_es(grq_url, grq_query):
+        poeorbs.setdefault(poeorb['_source'].get('metadata', {}).get('archive_filename'), poeorb)
+    return poeorbs
 
 def submit_enum_job(poeorb, aoi, track, queue, job_version, minmatch, acquisition_version, skip_days, enable_dedup):
     '''submits an enumeration job for the give poeorb, aoi, & track. if track is false, it does not use that parameter'''
+    job = build_enum_job(poeorb, aoi, track, queue, job_version, minmatch, acquisition_version, skip_days, enable_dedup)
+    return submit_job.main(**job)
+
+def build_enum_job(poeorb, aoi, track, queue, job_version, minmatch, acquisition_version, skip_days, enable_dedup):
+    '''returns the submit_job arguments of an enumeration job for the give poeorb, aoi, & track'''
     job_name = "job-standard_product-s1gunw-acq_enumerator"
     priority = 5
     tags = 'enumeration_from_blacklist'
@@ -132,7 +131,10 @@ def submit_enum_job(poeorb, aoi, track, queue, job_version, minmatch, acquisitio
         "platform": poeorb.get('_source').get('metadata').get('platform'),
         "localize_products": poeorb.get('_source').get('urls')[1]
     }
-    submit_job.main(job_name, job_params, job_version, queue, priority, tags, enable_dedup=enable_dedup)
+    if track is False:
+        del job_params['track_numbers']
+    return {'job_name': job_name, 'job_params': job_params, 'job_version': job_version, 'queue': queue,
+            'priority': priority, 'tags': tags, 'enable_dedup': enable_dedup}
 
 def load_context():
     '''loads the context file into a dict'''
@@ -145,4 +147,4 @@ def load_context():
         raise Exception('unable to parse _context.json from work directory')
 
 if __name__ == '__main__':
-    main()
+    metrics.run(main)
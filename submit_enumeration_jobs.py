@@ -4,10 +4,193 @@
 Submits enumeration job for every precision orbit in the ES index
 '''
 
+from __future__ import print_function
+import os
+import json
+import es_client
+import submit_job
+import metrics
+import submit_enumeration_from_blacklist as enum_from_blacklist
+
+POEORB_IDX = enum_from_blacklist.POEORB_IDX
+AUDIT_TRAIL_IDX = enum_from_blacklist.AUDIT_TRAIL_IDX
+AOI_IDX = 'grq_*_area_of_interest'
+AUDIT_ORBIT_FIELD = 'metadata.master_orbit_file.raw' # the orbit an enumeration audit trail was generated from
+AOI_TAG = 'standard_product' # machine tag of the AOIs standard products are enumerated over
+BATCH_SIZE = 100 # poeorbs submitted, & checkpointed, together
+# sweep checkpoint, holding the starttime & ids of the last poeorbs submitted. Kept on the worker
+# directory the validator job spec mounts, so a retried job resumes from it
+CHECKPOINT_FILE = '/data/work/standard_product_validator/submit_enumeration_checkpoint.json'
+MANIFEST = 'submitted_enumeration_jobs.json'
 
 def main():
-    pass
+    '''
+    Streams the poeorbs in starttime order, optionally limited to a time range, & submits
+    an enumeration job per poeorb & AOI covering it that has no enumeration audit trail.
+    The sweep resumes from its checkpoint if a previous run over the range was interrupted
+    or failed to submit some jobs. The checkpoint only advances past poeorbs whose jobs were
+    all submitted, & is kept for the next run until the whole range is.
+    '''
+    ctx = load_context()
+    version = ctx.get('enumeration_job_version')
+    if not version:
+        print('No enumeration_job_version given. Skipping poeorb enumeration.')
+        return
+    starttime = ctx.get('enumeration_starttime') or None
+    endtime = ctx.get('enumeration_endtime') or None
+    job_args = {'queue': ctx.get('enumerator_queue', 'standard_product-s1gunw-acq_enumerator'), 'job_version': version,
+                'minmatch': ctx.get('minMatch', 2), 'acquisition_version': ctx.get('acquisition_version'),
+                'skip_days': ctx.get('skipDays', 0), 'enable_dedup': True}
+    rate_limit = float(ctx.get('submit_rate_limit') or submit_job.RATE_LIMIT)
+    checkpoint_file = ctx.get('enumeration_checkpoint') or CHECKPOINT_FILE
+    checkpoint = load_checkpoint(checkpoint_file, starttime, endtime)
+    with metrics.phase('get_aois'):
+        aois = get_aois()
+    print('Found {} AOIs.'.format(len(aois)))
+    results = []
+    advancing = True # until a poeorb has a failed submission, past which the checkpoint stays
+    for batch in get_poeorbs(starttime, endtime, checkpoint):
+        advancing = submit_batch(batch, aois, job_args, rate_limit, checkpoint, checkpoint_file, results, advancing)
+    failed = [x for x in results if 'error' in x]
+    with open(MANIFEST, 'w') as fout:
+        json.dump({'submitted': [x for x in results if 'job_id' in x], 'failed': failed}, fout, indent=2)
+    if advancing and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    print('Submitted {} enumeration jobs, {} failed.'.format(len(results) - len(failed), len(failed)))
+    es_client.log_cache_stats()
+    if failed:
+        raise Exception('failed to submit {} of {} enumeration jobs. See {}'.format(len(failed), len(results), MANIFEST))
+
+def submit_batch(poeorbs, aois, job_args, rate_limit, checkpoint, checkpoint_file, results, advancing=True):
+    '''
+    Submits the enumeration jobs of the poeorbs over their covering AOIs, skipping those with an
+    audit trail, & adds the submission results to results. If advancing, the checkpoint is
+    advanced past the poeorbs before the first one with a failed submission. Returns True if
+    the checkpoint may still advance, ie advancing & every job was submitted.
+    '''
+    with metrics.phase('get_enumerated'):
+        enumerated = get_enumerated(poeorbs)
+    jobs = []
+    owners = [] # the position of each job's poeorb
+    for i, poeorb in enumerate(poeorbs):
+        orbit = poeorb['_source'].get('metadata', {}).get('archive_filename')
+        for aoi in covering_aois(poeorb, aois):
+            if (orbit, aoi['_id']) in enumerated:
+                continue
+            jobs.append(enum_from_blacklist.build_enum_job(poeorb, aoi['_id'], False, **job_args))
+            owners.append(i)
+    print('Submitting {} enumeration jobs for {} poeorbs...'.format(len(jobs), len(poeorbs)))
+    submitted = submit_job.submit_many(jobs, rate_limit=rate_limit) if jobs else []
+    results.extend(submitted)
+    failed = [i for i, result in zip(owners, submitted) if 'error' in result]
+    done = poeorbs[:min(failed)] if failed else poeorbs
+    if advancing and done:
+        advance_checkpoint(checkpoint_file, checkpoint, done)
+    return advancing and not failed
+
+def advance_checkpoint(checkpoint_file, checkpoint, poeorbs):
+    '''advances the checkpoint past the poeorbs, which are in starttime order, & saves it'''
+    last = poeorbs[-1]['_source']['starttime']
+    if last != checkpoint.get('starttime'):
+        checkpoint.update({'starttime': last, 'ids': []})
+    checkpoint['ids'].extend(x['_id'] for x in poeorbs if x['_source']['starttime'] == last)
+    save_checkpoint(checkpoint_file, checkpoint)
+
+def get_poeorbs(starttime, endtime, checkpoint, page_size=BATCH_SIZE):
+    '''
+    Streams pages of page_size poeorbs in the time range in starttime order, from the checkpoint
+    if given. Each page is a separate search from the starttime & ids of the last poeorbs paged,
+    so no scroll context is held open while a page's jobs are submitted.
+    '''
+    must = []
+    if starttime:
+        must.append({"range":{"endtime":{"gte":starttime}}})
+    if endtime:
+        must.append({"range":{"starttime":{"lte":endtime}}})
+    grq_url = es_client.grq_url(POEORB_IDX, '_search')
+    last, ids = checkpoint.get('starttime'), list(checkpoint.get('ids', []))
+    while True:
+        after = [{"range":{"starttime":{"gte":last}}}] if last else []
+        grq_query = {"query":{"filtered":{"filter":{"bool":{"must":must + after or [{"match_all":{}}],
+                                                            "must_not":[{"ids":{"values":ids}}]}}}},
+                     "_source":["starttime", "endtime", "metadata.platform", "metadata.archive_filename", "urls"],
+                     "sort":[{"starttime":"asc"}], "from":0, "size":page_size}
+        page = es_client.search(grq_url, grq_query).get('hits', {}).get('hits', [])
+        if not page:
+            return
+        yield page
+        if page[-1]['_source']['starttime'] != last:
+            last, ids = page[-1]['_source']['starttime'], []
+        ids.extend(x['_id'] for x in page if x['_source']['starttime'] == last)
+        if len(page) < page_size:
+            return
+
+def get_aois():
+    '''returns the AOIs with the standard product machine tag, with their time range'''
+    grq_url = es_client.grq_url(AOI_IDX, '_search')
+    grq_query = {"query":{"filtered":{"filter":{"term":{"metadata.tags.raw":AOI_TAG}}}}, "_source":["starttime", "endtime"]}
+    return es_client.query_es(grq_url, grq_query)
+
+def covering_aois(poeorb, aois):
+    '''returns the AOIs whose time range overlaps the poeorb'''
+    starttime = poeorb['_source'].get('starttime')
+    endtime = poeorb['_source'].get('endtime')
+    covering = []
+    for aoi in aois:
+        aoi_start = aoi.get('_source', {}).get('starttime')
+        aoi_end = aoi.get('_source', {}).get('endtime')
+        if (not aoi_start or not endtime or aoi_start <= endtime) and (not aoi_end or not starttime or aoi_end >= starttime):
+            covering.append(aoi)
+    return covering
+
+def get_enumerated(poeorbs):
+    '''returns the set of (orbit, aoi) pairs of the poeorbs that have an enumeration audit trail'''
+    orbits = [x['_source'].get('metadata', {}).get('archive_filename') for x in poeorbs]
+    orbits = [x for x in orbits if x]
+    if not orbits:
+        return set()
+    grq_url = es_client.grq_url(AUDIT_TRAIL_IDX, '_search')
+    grq_query = {"query":{"filtered":{"filter":{"terms":{AUDIT_ORBIT_FIELD:orbits}}}}, "size":0,
+                 "aggs":{"orbits":{"terms":{"field":AUDIT_ORBIT_FIELD, "size":len(orbits)},
+                                   "aggs":{"aois":{"terms":{"field":"metadata.aoi.raw", "size":0}}}}}}
+    results = es_client.search(grq_url, grq_query)
+    enumerated = set()
+    for orbit in results.get('aggregations', {}).get('orbits', {}).get('buckets', []):
+        for aoi in orbit['aois']['buckets']:
+            enumerated.add((orbit['key'], aoi['key']))
+    return enumerated
+
+def load_checkpoint(checkpoint_file, starttime, endtime):
+    '''loads the sweep checkpoint if one was left for the same time range, otherwise starts a new one'''
+    checkpoint = {'range': [starttime, endtime], 'starttime': None, 'ids': []}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as fin:
+            saved = json.load(fin)
+        if saved.get('range') == checkpoint['range']:
+            print('Resuming poeorb enumeration from {}.'.format(saved.get('starttime')))
+            return saved
+    return checkpoint
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    '''atomically writes the sweep checkpoint'''
+    checkpoint_dir = os.path.dirname(checkpoint_file)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    tmp_file = '{}.tmp'.format(checkpoint_file)
+    with open(tmp_file, 'w') as fout:
+        json.dump(checkpoint, fout)
+    os.rename(tmp_file, checkpoint_file)
+
+def load_context():
+    '''loads the context file into a dict'''
+    try:
+        context_file = '_context.json'
+        with open(context_file, 'r') as fin:
+            context = json.load(fin)
+        return context
+    except:
+        raise Exception('unable to parse _context.json from work directory')
 
 
 if __name__ == '__main__':
-    main()
+    metrics.run(main)
@@ -8,45 +8,129 @@ from __future__ import print_function
 import os
 import re
 import json
+import time
 import argparse
+import threading
 import requests
+from multiprocessing.pool import ThreadPool
 from hysds.celery import app
+import es_client
+import metrics
+
+WORKERS = 4
+RATE_LIMIT = 5.0 # max submissions per second across all workers, None disables
+RETRIES = 3
+BACKOFF = 2 # seconds before the first retry, doubled on each retry
 
 def main(job_name, job_params, job_version, queue, priority, tags, enable_dedup=True):
     '''
     submits a job to mozart to start pager job
     '''
-    # submit mozart job
-    job_submit_url = os.path.join(app.conf['MOZART_URL'], 'api/v0.2/job/submit')
-    params = {
+    params = build_params(job_name, job_params, job_version, queue, priority, tags, enable_dedup)
+    print('submitting jobs with params: %s' %  json.dumps(params))
+    job_id = submit(params)
+    print('submitted %s job version: %s job_id: %s' % (job_name, job_version, job_id))
+    return job_id
+
+def submit_many(jobs, workers=WORKERS, rate_limit=RATE_LIMIT, retries=RETRIES, manifest=None):
+    '''
+    Submits each job, a dict of the main() arguments, over a pool of workers sharing one
+    pooled session, starting at most rate_limit submissions per second. Returns a result dict
+    per job holding its job_id, or the error it failed with. The results are also written to
+    the manifest path if given.
+    '''
+    limiter = RateLimiter(rate_limit)
+    def submit_one(job):
+        result = {'job_name': job['job_name'], 'job_version': job['job_version'], 'params': job['job_params']}
+        try:
+            params = build_params(**job)
+            limiter.wait()
+            result['job_id'] = submit(params, retries)
+            print('submitted %s job version: %s job_id: %s' % (job['job_name'], job['job_version'], result['job_id']))
+        except Exception as err:
+            result['error'] = str(err)
+            print('failed to submit %s job: %s' % (job['job_name'], err))
+        return result
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        with metrics.phase('submit_jobs'):
+            results = pool.map(metrics.inherit_phases(submit_one), jobs)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [x for x in results if 'error' in x]
+    print('submitted %s of %s jobs' % (len(results) - len(failed), len(results)))
+    if manifest:
+        with open(manifest, 'w') as fout:
+            json.dump({'submitted': [x for x in results if 'job_id' in x], 'failed': failed}, fout, indent=2)
+    return results
+
+def build_params(job_name, job_params, job_version, queue, priority, tags, enable_dedup=True):
+    '''returns the mozart job submission params'''
+    return {
         'queue': queue,
         'priority': int(priority),
-        'tags': '[{0}]'.format(parse_job_tags(tags)),
+        'tags': json.dumps(parse_job_tags(tags)),
         'type': '%s:%s' % (job_name, job_version),
         'params': json.dumps(job_params),
         'enable_dedup': enable_dedup
     }
-    print('submitting jobs with params: %s' %  json.dumps(params))
-    r = requests.post(job_submit_url, params=params, verify=False)
+
+def submit(params, retries=RETRIES):
+    '''
+    posts the submission params to mozart over the shared session & returns the job id.
+    Failures are retried with exponential backoff. Mozart may have queued the job before a
+    5xx response, read timeout or dropped connection, so those are only retried when dedup
+    is enabled. Otherwise only connect timeouts, raised before the request is sent, are retried.
+    '''
+    job_submit_url = os.path.join(app.conf['MOZART_URL'], 'api/v0.2/job/submit')
+    dedup = params.get('enable_dedup', False)
+    retry_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout) if dedup else (requests.exceptions.ConnectTimeout,)
+    for attempt in range(retries + 1):
+        try:
+            start = time.time()
+            r = es_client.get_session().post(job_submit_url, params=params, headers={'Content-Type': None}, timeout=es_client.TIMEOUT)
+            metrics.record('mozart_job_submit', requests=1, bytes_received=len(r.content), request_time=time.time() - start)
+            if r.status_code < 500 or not dedup or attempt == retries:
+                break
+            print('submission returned %s, retrying' % r.status_code)
+        except retry_errors as err:
+            if attempt == retries:
+                raise
+            print('submission failed with %s, retrying' % err)
+        time.sleep(BACKOFF * 2 ** attempt)
     if r.status_code != 200:
         print('submission job failed')
         r.raise_for_status()
     result = r.json()
-    if 'result' in result.keys() and 'success' in result.keys():
-        if result['success'] == True:
-            job_id = result['result']
-            print('submitted %s job version: %s job_id: %s' % (job_name, job_version, job_id))
-        else:
-            raise Exception('job %s not submitted successfully: %s' % (job_name, result))
-    else:
-        raise Exception('job %s not submitted successfully: %s' % (job_name, result))
+    if result.get('success') == True and 'result' in result:
+        return result['result']
+    raise Exception('job %s not submitted successfully: %s' % (params['type'], result))
+
+class RateLimiter(object):
+    '''spaces out calls to wait() across threads to at most rate per second'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        '''blocks until the next call slot'''
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
 def parse_job_tags(tag_string):
+    '''returns the list of tags from a comma separated tag string'''
     if tag_string == None or tag_string == '' or (type(tag_string) is list and tag_string == []) :
-        return ''
-    tag_list = tag_string.split(',')
-    tag_list = ['"{0}"'.format(tag) for tag in tag_list]
-    return ','.join(tag_list)
+        return []
+    if isinstance(tag_string, list):
+        return tag_string
+    return tag_string.split(',')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
@@ -4,15 +4,22 @@
 Tags standard product, and co-located products, as validated/invalid/in-progress
 '''
 
-import re
+from __future__ import print_function
 import json
-import pickle
-import hashlib
-import requests
-from hysds.celery import app
-import urllib3
 from collections import OrderedDict
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from multiprocessing.pool import ThreadPool
+import es_client
+import scene_key
+import bloom_filter
+import metrics
+
+# swaps the aoi status tags in place, skipping the write if the tags are unchanged. Needs inline groovy
+# scripts enabled for updates on GRQ (script.inline: on in ES 2.x, script.disable_dynamic: false in 1.x),
+# otherwise tagging falls back to reading the tags & writing them back
+TAG_SCRIPT = ("def current = (ctx._source.metadata.tags ?: []) as Set; "
+              "def updated = (current - remove_tags) + [new_tag]; "
+              "if (updated == current) { ctx.op = 'none' } else { ctx._source.metadata.tags = updated as List }")
+_SCRIPTS_DISABLED = False # set once GRQ refuses the tag script, so later AOIs go straight to the fallback
 
 def main():
     '''main function, tags all appropriate ifgs using the given input ifg'''
@@ -22,54 +29,84 @@ def main():
     ifg_index = ctx.get('ifg_index')
     orbitNumber = ctx.get('orbitNumber')
     aoi_name = ctx.get('AOI', False)
+    batch_size = int(ctx.get('tag_batch_size', es_client.BULK_SIZE))
+    concurrency = int(ctx.get('aoi_concurrency', 1))
     print('orbitnumber: {}'.format(orbitNumber))
     #query AOIs over location
     print('Retrieving AOI\'s over product extent...')
-    aois = get_aois(coordinates)
+    with metrics.phase('get_aois'):
+        aois = get_aois(coordinates)
     if aoi_name:
         print('Enumerating over AOI {} only.'.format(aoi_name))
         aois = [x for x in aois if x.get('_id', '') == aoi_name] #filter out other AOIs
     print('Found AOIs: {}'.format(', '.join([x.get('_id') for x in aois])))
+    bloom = bloom_filter.load_latest()
+    if concurrency > 1 and len(aois) > 1:
+        #evaluate each AOI as its own task, printing each AOI's output as a block
+        print('Evaluating {} AOIs with a concurrency of {}...'.format(len(aois), concurrency))
+        pool = ThreadPool(min(concurrency, len(aois)))
+        try:
+            evaluate = metrics.inherit_phases(lambda aoi: evaluate_aoi(aoi, orbitNumber, ifg_index, batch_size, bloom=bloom))
+            for output in pool.imap(evaluate, aois):
+                print('\n'.join(output))
+        finally:
+            pool.close()
+            pool.join()
+        es_client.log_cache_stats()
+        return
+    #query acq-list, ifg & blacklist products for every AOI at once
+    print('Retrieving products over all AOIs...')
+    with metrics.phase('get_objects'):
+        aoi_objects = get_all_objects(aois, orbitNumber, ifg_index, bloom=bloom)
     #for each AOI
     for aoi in aois:
+        output = evaluate_aoi(aoi, orbitNumber, ifg_index, batch_size, objects=aoi_objects[aoi['_id']])
+        print('\n'.join(output))
+    es_client.log_cache_stats()
+
+def evaluate_aoi(aoi, orbitNumber, ifg_index, batch_size, objects=None, bloom=None):
+    '''
+    Determines the status of the AOI & tags its ifgs. The (acq-list, ifg, ifg-blacklist) objects
+    are queried if they are not given. Returns the output lines of the evaluation.
+    '''
+    with metrics.phase('aoi:{0}'.format(aoi['_id'])):
+        output = []
         aoi_name = aoi['_id']
-        print('\nRetrieving products over {}...\n-----------------------'.format(aoi_name))
-        #query for ACQ-list
-        acq_list = get_objects('acq-list', aoi, orbitNumber)
-        print('Found {} acquisition-list products.'.format(len(acq_list)))
+        output.append('\nRetrieving products over {}...\n-----------------------'.format(aoi_name))
+        if objects is None:
+            with metrics.phase('get_objects'):
+                objects = get_all_objects([aoi], orbitNumber, ifg_index, bloom=bloom)[aoi_name]
+        acq_list, ifg_list, ifg_blacklist = objects
+        output.append('Found {} acquisition-list products.'.format(len(acq_list)))
         if len(acq_list) == 0:
-            print('Since 0 acq-list products have been found, ending AOI tagging.')
-            continue
-        #query for IFG
-        ifg_list = get_objects('ifg', aoi, orbitNumber, index=ifg_index)
-        print('Found {} ifg products.'.format(len(ifg_list)))
-        #query for IFG blacklist products
-        ifg_blacklist = get_objects('ifg-blacklist', aoi, orbitNumber)
-        print('Found {} blacklist products.'.format(len(ifg_blacklist)))
+            output.append('Since 0 acq-list products have been found, ending AOI tagging.')
+            return output
+        output.append('Found {} ifg products.'.format(len(ifg_list)))
+        output.append('Found {} blacklist products.'.format(len(ifg_blacklist)))
         #if any blacklist products match (list is empty)
-        print('Determining matching products...')
-        matching_blacklist = return_matching(ifg_blacklist, acq_list)
+        output.append('Determining matching products...')
+        with metrics.phase('matching'):
+            matching_blacklist = return_matching(ifg_blacklist, acq_list)
+            all_contained = not matching_blacklist and contains(ifg_list, acq_list)
         if len(matching_blacklist) > 0:
             #tag all IFG products as <AOI_name>_invalid
-            print('Found matching blacklist products. Tagging as invalid.')
+            output.append('Found matching blacklist products. Tagging as invalid.')
             tag = '{0}_invalid'.format(aoi_name)
-            tag_all(ifg_list, tag, ifg_index, aoi_name)
-        elif contains(ifg_list, acq_list):
+        elif all_contained:
             #if all of the ACQ-list are contained in the IFG products
             #tag all <AOI_name>_validated
-            print('All input acq-lists are contained by the ifg products. Tagging as validated')
+            output.append('All input acq-lists are contained by the ifg products. Tagging as validated')
             tag = '{0}_validated'.format(aoi_name)
-            tag_all(ifg_list, tag, ifg_index, aoi_name)
         else:
             #tag all <AOI_name>_in-progress (if not already)
-            print('Missing ifg products from acq-lists. Tagging as in-progress')
-            print('Missing acq-list Products:\n------------------')
+            output.append('Missing ifg products from acq-lists. Tagging as in-progress')
+            output.append('Missing acq-list Products:\n------------------')
             missing = return_missing(ifg_list, acq_list)
-            ids = [x['_id'] for x in missing]
-            for i in ids:
-                print(i)
+            output.extend([x['_id'] for x in missing])
             tag = '{0}_in-progress'.format(aoi_name)
-            tag_all(ifg_list, tag, ifg_index, aoi_name)
+        with metrics.phase('tag_all'):
+            tag_all(ifg_list, tag, ifg_index, aoi_name, batch_size, log=output.append)
+        return output
 
 def load_context():
     '''loads the context file into a dict'''
@@ -85,11 +122,10 @@ def get_aois(coordinates):
     '''gets AOIs over the given location that have the standard_product machine tag'''
     print('coordinates: {}'.format(coordinates))
     #location['shape']['type'] = 'polygon'
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/grq_*_area_of_interest/_search'.format(grq_ip)
+    grq_url = es_client.grq_url('grq_*_area_of_interest', '_search')
     #grq_query = {"query":{"filtered":{"query":{"bool":{"must":[{"term":{"dataset_type":"area_of_interest"}}]}}, "filter":{"geo_shape":{"location":location}}}}, "fields":["_id", "_source"]}
-    grq_query = {"query":{"geo_shape":{"location":{"shape":{"type": "polygon", "coordinates": coordinates}}}}}
-    results = query_es(grq_url, grq_query)
+    grq_query = {"query":{"geo_shape":{"location":{"shape":{"type": "polygon", "coordinates": coordinates}}}}, "_source":["starttime", "endtime", "location"]}
+    results = es_client.query_es(grq_url, grq_query)
     #return only standard product tags
     #std_only = []
     #for prod in results:
@@ -98,9 +134,53 @@ def get_aois(coordinates):
     #return std_only
     return results
 
+def get_all_objects(aois, orbitNumber, ifg_index, bloom=None):
+    '''
+    Returns a dict of aoi id to its (acq-list, ifg, ifg-blacklist) objects. All of the queries
+    are sent together through _msearch. Given the list bloom filter, only blacklist products
+    created since the filter was built are queried, plus the full blacklist for the AOIs with
+    an acq-list hash the filter can not rule out.
+    '''
+    since = bloom.meta.get('checkpoint') if bloom is not None else None
+    searches = []
+    for aoi in aois:
+        searches.append(build_objects_query('acq-list', aoi, orbitNumber))
+        searches.append(build_objects_query('ifg', aoi, orbitNumber, index=ifg_index))
+        searches.append(build_objects_query('ifg-blacklist', aoi, orbitNumber, since=since))
+    results = es_client.multi_query_es(searches)
+    aoi_objects = {}
+    for i, aoi in enumerate(aois):
+        aoi_objects[aoi['_id']] = tuple(results[3 * i:3 * i + 3])
+    if since:
+        confirm = [aoi for aoi in aois if maybe_blacklisted(aoi_objects[aoi['_id']][0], bloom)]
+        print('Bloom filter ruled out the blacklist for {} of {} AOIs.'.format(len(aois) - len(confirm), len(aois)))
+        blacklists = es_client.multi_query_es([build_objects_query('ifg-blacklist', aoi, orbitNumber) for aoi in confirm])
+        for aoi, blacklist in zip(confirm, blacklists):
+            acq_list, ifg_list, _ = aoi_objects[aoi['_id']]
+            aoi_objects[aoi['_id']] = (acq_list, ifg_list, blacklist)
+    return aoi_objects
+
+def maybe_blacklisted(acq_list, bloom):
+    '''returns True unless the bloom filter rules out every acq-list. Acq-lists without a stored
+    full_id_hash can only be matched on ES'''
+    for obj in acq_list:
+        key = scene_key.from_es_object(obj)
+        if not key.stored_hash or key.stored_hash in bloom:
+            return True
+    return False
+
 def get_objects(object_type, aoi, orbitNumber, index=None):
     '''returns all objects of the object type ['ifg, acq-list, 'ifg-blacklist'] that intersect both
     temporally and spatially with the aoi'''
+    idx, grq_query = build_objects_query(object_type, aoi, orbitNumber, index=index)
+    grq_url = es_client.grq_url(idx, '_search')
+    with metrics.phase('get_objects'):
+        results = es_client.query_es(grq_url, grq_query)
+    return results
+
+def build_objects_query(object_type, aoi, orbitNumber, index=None, since=None):
+    '''returns the (index, query) for objects of the object type that intersect both
+    temporally and spatially with the aoi, limited to those created since the given timestamp'''
     #determine index
     if index is not None:
         idx = index
@@ -111,152 +191,107 @@ def get_objects(object_type, aoi, orbitNumber, index=None):
     endtime = aoi.get('_source', {}).get('endtime')
     location = aoi.get('_source', {}).get('location')
     #location['type'] = 'polygon'
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/_search'.format(grq_ip, idx)
-    grq_query = {"query":{"filtered":{"query":{"geo_shape":{"location": {"shape":location}}},"filter":{"bool":{"must":[{"term":{"metadata.orbitNumber":orbitNumber[0]}},{"term":{"metadata.orbitNumber":orbitNumber[1]}},{"range":{"starttime":{"from":starttime,"to":endtime}}}]}}}},"from":0,"size":100}
+    grq_query = {"query":{"filtered":{"query":{"geo_shape":{"location": {"shape":location}}},"filter":{"bool":{"must":[{"term":{"metadata.orbitNumber":orbitNumber[0]}},{"term":{"metadata.orbitNumber":orbitNumber[1]}},{"range":{"starttime":{"from":starttime,"to":endtime}}}]}}}},"_source":scene_key.SOURCE_FIELDS,"from":0,"size":100}
     if object_type == 'ifg':
         #orbitNumber has been updated to orbit_number in ifg metadata
-        grq_query = {"query":{"filtered":{"query":{"geo_shape":{"location": {"shape":location}}},"filter":{"bool":{"must":[{"term":{"metadata.orbit_number":orbitNumber[0]}},{"term":{"metadata.orbit_number":orbitNumber[1]}},{"range":{"starttime":{"from":starttime,"to":endtime}}}]}}}},"from":0,"size":100}
-    results = query_es(grq_url, grq_query)
-    return results
-
-def query_es(grq_url, es_query):
-    '''
-    Runs the query through Elasticsearch, iterates until
-    all results are generated, & returns the compiled result
-    '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in es_query.keys():
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 1000
-        es_query['size'] = iterator_size
-    if 'from' in es_query.keys():
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    #run the query and iterate until all the results have been returned
-    #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    #print('status code: {}'.format(response.status_code))
-    #print('response text: {}'.format(response.text))
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        #print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
+        grq_query = {"query":{"filtered":{"query":{"geo_shape":{"location": {"shape":location}}},"filter":{"bool":{"must":[{"term":{"metadata.orbit_number":orbitNumber[0]}},{"term":{"metadata.orbit_number":orbitNumber[1]}},{"range":{"starttime":{"from":starttime,"to":endtime}}}]}}}},"_source":scene_key.SOURCE_FIELDS,"from":0,"size":100}
+    if since:
+        grq_query['query']['filtered']['filter']['bool']['must'].append({"range":{"creation_timestamp":{"gte":"{0}||-{1}".format(since, bloom_filter.CHECKPOINT_OVERLAP)}}})
+    return idx, grq_query
 
 def are_match(es_object1, es_object2):
     '''returns True if the objects share the same set of master/slave scenes, False otherwise'''
-    if gen_hash(es_object1) == gen_hash(es_object2):
-        return True
-    return False
+    return scene_key.from_es_object(es_object1).matches(scene_key.from_es_object(es_object2))
 
 def contains(list1, list2):
     '''returns True if list1 contains all products in list2. False otherwise'''
     hashlist1 = build_hashed_dict(list1)
-    hashlist2 = build_hashed_dict(list2)
-    for key in hashlist2.keys():
-        if hashlist1.get(key, False) is False:
+    for obj in list2:
+        if scene_key.from_es_object(obj) not in hashlist1:
             return False
     return True
 
 def return_missing(list1, list2):
     '''returns the products in list2 that are NOT contained by list1'''
-    missing = []
     hashlist1 = build_hashed_dict(list1)
-    hashlist2 = build_hashed_dict(list2)
-    for key in hashlist2.keys():
-        obj = hashlist1.get(key)
-        if obj is None:
-            missing.append(hashlist2[key])
-    return missing
+    return [obj for obj in list2 if scene_key.from_es_object(obj) not in hashlist1]
 
 def return_matching(list1, list2):
-    '''returns a list of matching objects between the two lists'''
+    '''returns a list of the objects in list2 that match an object in list1'''
     matching = []
-    hashlist1 = build_hashed_dict(list1)
     hashlist2 = build_hashed_dict(list2)
-    for key in hashlist1.keys():
-        obj = hashlist2.get(key)
-        if obj is not None:
-            matching.append(obj)
+    for obj in list1:
+        match = hashlist2.get(scene_key.from_es_object(obj))
+        if match is not None:
+            matching.append(match)
     return matching
 
 def build_hashed_dict(object_list):
     '''
-    Builds a dict of the object list where the keys are a hashed object of each objects
-    master and slave list. Returns the dict.
+    Builds a scene_key.KeyIndex of the object list, keyed on each objects master and
+    slave list. Returns the index.
     '''
-    hashed_dict = {}
-    for obj in object_list:
-        hashed_dict.update({gen_hash(obj):obj})
-    return hashed_dict
+    return scene_key.KeyIndex(object_list)
 
-def gen_hash(es_object):
-    '''Generates a hash from the master and slave scene list'''
-    #master = pickle.dumps(sorted(es_object['_source']['metadata']['master_scenes']))
-    #slave = pickle.dumps(sorted(es_object['_source']['metadata']['slave_scenes']))
-    #return '{}_{}'.format(hashlib.md5(master).hexdigest(), hashlib.md5(slave).hexdigest())
-    met = es_object.get('_source', {}).get('metadata', {})
-    master = [get_starttime(x) for x in met.get('master_scenes', [])]
-    slave = [get_starttime(x) for x in met.get('slave_scenes', [])]
-    master = pickle.dumps(sorted(master))
-    slave = pickle.dumps(sorted(slave))
-    return '{}_{}'.format(hashlib.md5(master).hexdigest(), hashlib.md5(slave).hexdigest())
-
-def get_starttime(input_string):
-    '''returns the starttime from the input string. Used for comparison of acquisition ids to SLC ids'''
-    st_regex = '([1-2][0-9]{7}T[0-2][0-9][0-6][0-9][0-6][0-9])'
-    result = re.search(st_regex, input_string)
-    try:
-        starttime = result.group(0)
-        return starttime
-    except Exception, err:
-        raise Exception('input product: {} does not match regex:{}. Cannot compare SLCs to acquisition ids.'.format(input_string, st_regex))
-
-def tag_all(object_list, tag, index, aoi_name):
-    '''tags all objects in object list with the given tag'''
-    for obj in object_list:
-        tags = get_current_tags(obj) #gets the current tags from es. this is needed bc we do mulitple updates
-        #remove any that might be already tagged
-        remove_tags = ['{0}_in-progress'.format(aoi_name), '{0}_validated'.format(aoi_name), '{0}_invalid'.format(aoi_name)]
-        tags = [x for x in tags if x not in remove_tags]
-        tags.append(tag)
-        prod_type = obj['_type']
-        add_tags(index, obj['_id'], prod_type, list(set(tags)))
-        print('updated {} with tag: {}'.format(obj.get('_id'), tag))
+def tag_all(object_list, tag, index, aoi_name, batch_size=es_client.BULK_SIZE, log=print):
+    '''
+    tags all objects in object list with the given tag. Tags are swapped on the server
+    with a scripted update, sent through _bulk in batches of batch_size. If GRQ has inline
+    scripting disabled, the tags are read & written back instead. Messages are passed to log.
+    '''
+    global _SCRIPTS_DISABLED
+    remove_tags = ['{0}_in-progress'.format(aoi_name), '{0}_validated'.format(aoi_name), '{0}_invalid'.format(aoi_name)]
+    pending = object_list
+    failed = []
+    if not _SCRIPTS_DISABLED:
+        params = {'remove_tags': remove_tags, 'new_tag': tag}
+        actions = []
+        for obj in object_list:
+            action = {'update': {'_index': index, '_type': obj['_type'], '_id': obj['_id'], '_retry_on_conflict': 3}}
+            actions.append((action, {'script': TAG_SCRIPT, 'params': params}))
+        failed = es_client.bulk(es_client.grq_url('_bulk'), actions, batch_size=batch_size)
+        rejected = set(status.get('_id') for status in failed if is_script_disabled(status.get('error')))
+        if rejected:
+            log('inline scripts are disabled on GRQ, tagging by reading & writing back the tags.')
+            _SCRIPTS_DISABLED = True
+        pending = [obj for obj in object_list if obj['_id'] in rejected]
+        failed = [status for status in failed if status.get('_id') not in rejected]
+    if pending:
+        failed.extend(tag_by_doc(pending, tag, index, remove_tags, batch_size))
+    for status in failed:
+        log('failed to update {} with tag: {}. {}'.format(status.get('_id'), tag, status.get('error')))
+    if failed:
+        raise Exception('failed to tag {} of {} products with {}'.format(len(failed), len(object_list), tag))
+    log('updated {} products with tag: {}'.format(len(object_list), tag))
 
-def add_tags(index, uid, prod_type, tags):
-    '''updates the product with the given tag'''
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/{2}/{3}/_update'.format(grq_ip, index, prod_type, uid)    
-    es_query = {"doc" : {"metadata": {"tags" : tags}}}
-    #print('querying {} with {}'.format(grq_url, es_query))
-    response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-    response.raise_for_status()
+def is_script_disabled(error):
+    '''returns True if the bulk item error is ES refusing to run an inline script'''
+    error = str(error).lower()
+    return 'script' in error and 'disabled' in error
 
-def get_current_tags(obj):
-    '''gets the current tags of the object'''
-    uid = obj.get('_id')
-    prod_type = obj.get('_type')
-    index = obj.get('_index')
-    grq_ip = app.conf['GRQ_ES_URL'].replace(':9200', '').replace('http://', 'https://')
-    grq_url = '{0}/es/{1}/{2}/_search'.format(grq_ip, index, prod_type)
-    grq_query = {"query": {"bool": {"must": {"match": {"_id": uid}}}}}
-    results = query_es(grq_url, grq_query)
-    tags = results[0].get('_source', {}).get('metadata', {}).get('tags', [])
-    print('current tags: {}'.format(tags))
-    return tags
+def tag_by_doc(object_list, tag, index, remove_tags, batch_size=es_client.BULK_SIZE):
+    '''
+    Tags the objects by reading their current tags & writing back the swapped tags as
+    partial doc updates through _bulk, skipping those already tagged. Used when the tag
+    script is refused. Returns the failed bulk items.
+    '''
+    failed = []
+    grq_url = es_client.grq_url(index, '_search')
+    for i in range(0, len(object_list), batch_size):
+        ids = [obj['_id'] for obj in object_list[i:i + batch_size]]
+        es_query = {"query":{"ids":{"values":ids}}, "_source":["metadata.tags"]}
+        actions = []
+        for hit in es_client.query_es(grq_url, es_query):
+            current = hit.get('_source', {}).get('metadata', {}).get('tags') or []
+            tags = [x for x in current if x not in remove_tags]
+            tags.append(tag)
+            if set(tags) == set(current):
+                continue
+            action = {'update': {'_index': hit['_index'], '_type': hit['_type'], '_id': hit['_id']}}
+            actions.append((action, {'doc': {'metadata': {'tags': sorted(set(tags))}}}))
+        failed.extend(es_client.bulk(es_client.grq_url('_bulk'), actions, batch_size=batch_size))
+    return failed
 
 
 if __name__ == '__main__':
-    main()
+    metrics.run(main)
@@ -0,0 +1,12 @@
+'''
+pytest setup for the unit tests: puts the repo modules on the path. The job scripts
+import hysds, which is only installed on the workers, so their tests are skipped
+without it.
+'''
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
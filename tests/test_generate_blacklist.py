@@ -0,0 +1,31 @@
+'''
+Tests of the generate_blacklist job params:
+
+    pytest tests
+'''
+
+import pytest
+pytest.importorskip('hysds.dataset_ingest')
+import generate_blacklist
+
+@pytest.mark.parametrize('value, expected', [
+    ('false', False), ('False', False), ('true', True), ('True', True), (False, False), (True, True), ('', False)])
+def test_get_flag(value, expected):
+    assert generate_blacklist.get_flag({'incremental': value}, 'incremental') is expected
+
+def test_get_flag_missing():
+    assert generate_blacklist.get_flag({}, 'incremental') is False
+
+@pytest.mark.parametrize('full_rebuild, loads_state', [('false', True), ('true', False)])
+def test_main_full_rebuild(monkeypatch, full_rebuild, loads_state):
+    ctx = {'acquisition_list_version': 'v2.0.0', 'blacklist_at_failure_count': 3,
+           'incremental': 'true', 'full_rebuild': full_rebuild, 'state_file': 'state.json'}
+    loaded = []
+    monkeypatch.setattr(generate_blacklist, 'load_context', lambda: ctx)
+    monkeypatch.setattr(generate_blacklist, 'load_state', lambda state_file, version: loaded.append(state_file))
+    monkeypatch.setattr(generate_blacklist, 'determine_all_missing', lambda state: [])
+    monkeypatch.setattr(generate_blacklist, 'save_state', lambda state_file, state: None)
+    monkeypatch.setattr(generate_blacklist, 'determine_failed', lambda missing, count: [])
+    monkeypatch.setattr(generate_blacklist, 'get_full_objects', lambda objects, fields: [])
+    generate_blacklist.main()
+    assert loaded == (['state.json'] if loads_state else [])
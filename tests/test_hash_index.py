@@ -0,0 +1,54 @@
+'''
+Tests of the local hash index refresh against a stubbed GRQ index:
+
+    pytest tests
+'''
+
+import pytest
+pytest.importorskip('hysds.celery')
+import es_client
+import hash_index
+
+INDEX = 'grq_*_s1-gunw'
+
+def product(doc_id, full_id_hash, timestamp):
+    return {'_id': doc_id, '_source': {'creation_timestamp': timestamp, 'metadata': {'full_id_hash': full_id_hash}}}
+
+@pytest.fixture
+def products(monkeypatch):
+    '''the products of the stubbed index, scanned & counted on creation_timestamp without date math'''
+    docs = []
+    def scan(url, es_query, **kwargs):
+        since = es_query['query']['bool']['must'][0].get('range', {}).get('creation_timestamp', {}).get('gte', '')
+        return [x for x in docs if x['_source']['creation_timestamp'] >= since.split('||')[0]]
+    def search(url, es_query):
+        until = es_query['query']['bool']['should'][0]['range']['creation_timestamp']['lte'] if 'query' in es_query else None
+        return {'hits': {'total': len([x for x in docs if until is None or x['_source']['creation_timestamp'] <= until])}}
+    monkeypatch.setattr(es_client, 'grq_url', lambda *parts: '/'.join(parts))
+    monkeypatch.setattr(es_client, 'scan', scan)
+    monkeypatch.setattr(es_client, 'search', search)
+    return docs
+
+def test_refresh_loads_new_products(tmpdir, products):
+    products.extend([product('a', 'ha', '2019-01-01T00:00:00'), product('b', 'hb', '2019-01-02T00:00:00')])
+    index = hash_index.HashIndex(str(tmpdir.join('hash_index.db')))
+    assert index.find_existing(INDEX, ['ha', 'hb', 'hc']) == set(['ha', 'hb'])
+    assert index.get_checkpoint(INDEX) == '2019-01-02T00:00:00'
+    products.append(product('c', 'hc', '2019-01-03T00:00:00'))
+    index = hash_index.HashIndex(index.path)
+    assert index.find_existing(INDEX, ['ha', 'hb', 'hc']) == set(['ha', 'hb', 'hc'])
+    assert index.get_checkpoint(INDEX) == '2019-01-03T00:00:00'
+
+def test_refresh_drops_deleted_products(tmpdir, products):
+    products.extend([product('a', 'ha', '2019-01-01T00:00:00'), product('b', 'hb', '2019-01-02T00:00:00')])
+    index = hash_index.HashIndex(str(tmpdir.join('hash_index.db')))
+    assert index.find_existing(INDEX, ['ha', 'hb']) == set(['ha', 'hb'])
+    del products[0]
+    index = hash_index.HashIndex(index.path)
+    assert index.find_existing(INDEX, ['ha', 'hb']) == set(['hb'])
+    assert index.count(INDEX) == 1
+
+def test_find_existing_over_indices(tmpdir, products):
+    products.append(product('a', 'ha', '2019-01-01T00:00:00'))
+    index = hash_index.HashIndex(str(tmpdir.join('hash_index.db')))
+    assert index.find_existing('{0},grq_*_s1-gunw-blacklist'.format(INDEX), ['ha', 'hb']) == set(['ha'])